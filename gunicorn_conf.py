@@ -0,0 +1,24 @@
+# Gunicorn config (Dockerfile / Procfile: gunicorn -c gunicorn_conf.py main:app)
+#
+# Default: gthread (1 worker, 8 thread), timeout 30s (worker hang di-kill).
+# Dockerfile set GUNICORN_TIMEOUT=0 (Cloud Run urus request timeout sendiri).
+# Untuk gevent: GUNICORN_WORKER_CLASS=gevent (perlu `pip install gevent psycogreen`).
+import os
+
+bind = f":{os.getenv('PORT', '8080')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "65"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+
+
+def post_fork(server, worker):
+    # psycopg2 block event loop kalau tak di-patch (gevent sahaja)
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.warning("gevent worker without psycogreen: DB calls will block the loop")
@@ -1,21 +1,38 @@
 import os
+
+# gevent (opt-in): patch stdlib sebelum threading/socket/requests di-import.
+# gunicorn -k gevent patch sendiri; flag ni untuk run main.py terus dengan gevent.
+if os.getenv("GEVENT_PATCH", "0") == "1":
+    from gevent import monkey
+    monkey.patch_all()
+
 import re
 import json
+import socket
 import time
 import uuid
 import random
 import logging
 import html
-from io import BytesIO
+import heapq
+import queue
+import itertools
+import threading
+from io import BytesIO, StringIO
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple, List, Dict
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify
 
 import sqlalchemy as sa
 from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 
 from openpyxl import Workbook
 
@@ -48,8 +65,12 @@ if not DATABASE_URL:
 APP_TZ_NAME = os.getenv("TZ", "Asia/Kuala_Lumpur")
 LOCAL_TZ = ZoneInfo(APP_TZ_NAME) if ZoneInfo else None
 
-DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "3"))
-DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "7"))
+# QueuePool (PgBouncer transaction-mode safe): recycle pendek, tiada pre-ping
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "60"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0").strip().lower() in ("1", "true", "yes", "on")
 
 AFFILIATE_AMOUNT = float(os.getenv("AFFILIATE_AMOUNT", "1.00"))
 
@@ -68,6 +89,9 @@ TASKS_SECRET = os.getenv("TASKS_SECRET", "").strip()
 
 SERVICE_NAME = os.getenv("SERVICE_NAME", "boda8-bot")
 
+# Port untuk `python main.py` (gunicorn baca PORT sendiri dalam gunicorn_conf.py)
+PORT = int(os.getenv("PORT", "8080"))
+
 # untuk /addbot auto setWebhook
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")
 
@@ -77,6 +101,33 @@ SETTINGS_CB_PAGE_SIZE = int(os.getenv("SETTINGS_CB_PAGE_SIZE", "12"))
 # Admin management defaults
 ADMIN_DEFAULT_DAYS = int(os.getenv("ADMIN_DEFAULT_DAYS", "30"))
 
+# Inbound webhook load shedding (per bot). WEBHOOK_RATE<=0 disables it.
+WEBHOOK_RATE = float(os.getenv("WEBHOOK_RATE", "20"))
+WEBHOOK_BURST = float(os.getenv("WEBHOOK_BURST", "50"))
+
+# Max callback_query diproses serentak (default = saiz DB pool + overflow, supaya checkout tak block)
+CB_MAX_PARALLEL = int(os.getenv("CB_MAX_PARALLEL", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
+# Had hantar Telegram per bot token (msg/saat). Telegram benarkan ~30/s. <=0 = disable
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE", "28"))
+
+# bot row cache TTL (saat). 0 = disable
+BOT_CACHE_TTL = float(os.getenv("BOT_CACHE_TTL", "3"))
+
+# actions row cache TTL (saat). 0 = disable
+ACTIONS_CACHE_TTL = float(os.getenv("ACTIONS_CACHE_TTL", "5"))
+
+# Delayed callback fallback (bila Cloud Tasks tiada): 1 scheduler thread + worker pool
+DELAY_MAX_WORKERS = int(os.getenv("DELAY_MAX_WORKERS", "16"))
+DELAY_MAX_PENDING = int(os.getenv("DELAY_MAX_PENDING", "500"))
+
+# Outbound send queue (notifikasi admin dihantar oleh worker, webhook tak tunggu)
+OUT_QUEUE_MAX = int(os.getenv("OUT_QUEUE_MAX", "10000"))
+OUT_WORKERS = int(os.getenv("OUT_WORKERS", "4"))
+
+# Outbound HTTP keep-alive pool ke api.telegram.org
+TG_HTTP_POOL_SIZE = int(os.getenv("TG_HTTP_POOL_SIZE", "100"))
+
 # Safety: max length for TG message (HTML)
 TG_MAX_TEXT = int(os.getenv("TG_MAX_TEXT", "3500"))  # safe margin for HTML parsing
 TG_MAX_CAPTION = int(os.getenv("TG_MAX_CAPTION", "900"))  # caption limit is smaller; keep safe
@@ -88,17 +139,153 @@ TG_MAX_CAPTION = int(os.getenv("TG_MAX_CAPTION", "900"))  # caption limit is sma
 app = Flask(__name__)
 app.url_map.strict_slashes = False  # /healthz dan /healthz/ sama-sama ok
 
+# Tanda "DB sesak/putus" untuk request semasa (thread ni). Ramai handler telan exception
+# DB sendiri, jadi webhook bucket baca flag ni, bukan hanya exception yang naik.
+_DB_ERR = threading.local()
+
+# Error yang betul-betul tanda DB congestion (bukan IntegrityError/DataError yang memang
+# dijangka, cth nombor phone duplicate). Pool checkout timeout = sa.exc.TimeoutError.
+_DB_CONGESTION_ERRORS = (sa.exc.OperationalError, sa.exc.TimeoutError)
+
+
 engine = sa.create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,
+    poolclass=QueuePool,
+    pool_pre_ping=DB_POOL_PRE_PING,
     pool_size=DB_POOL_SIZE,
     max_overflow=DB_MAX_OVERFLOW,
-    pool_recycle=1800,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_reset_on_return="rollback",
+    query_cache_size=1200,
     future=True,
 )
 
+
+@sa.event.listens_for(engine, "handle_error")
+def _mark_db_error(ctx) -> None:
+    # connection putus / statement atau lock timeout (psycopg2 -> OperationalError) sahaja
+    if ctx.is_disconnect or isinstance(ctx.sqlalchemy_exception, sa.exc.OperationalError):
+        _DB_ERR.seen = True
+
+
 TG_API = "https://api.telegram.org/bot{token}/{method}"
 SESSION = requests.Session()
+# Keep-alive pool + retry/backoff. urllib3 Retry hanya ulang method idempotent (GET),
+# jadi POST sendMessage tak akan terhantar dua kali.
+class _KeepAliveAdapter(HTTPAdapter):
+    # SO_KEEPALIVE supaya connection idle dalam pool tak mati senyap (NAT/LB drop)
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+SESSION.mount("https://", _KeepAliveAdapter(
+    pool_connections=20,
+    pool_maxsize=TG_HTTP_POOL_SIZE,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Static SQL (build once, reuse -> same statement text every call)
+_SET_START_STMT = text("UPDATE bots SET start_text=:t, start_media_type=:mt, start_media_file_id=:mf WHERE id=:i")
+_SET_LOADING_STMT = text("UPDATE bots SET loading_text=:t, loading_media_type=:mt, loading_media_file_id=:mf WHERE id=:i")
+
+# column names here are fixed (never user input)
+SQL_UPD_BOT_TEXT = {
+    col: text(f"UPDATE bots SET {col}=:t WHERE id=:i")
+    for col in (
+        "join_targets", "join_message", "contact_message", "pending_message",
+        "verified_message", "rejected_message", "group_contact_message", "withdrawal_prompt",
+    )
+}
+SQL_UPD_WD_APPROVE_MSG = text("""
+    UPDATE bots
+    SET withdrawal_approve_message=:t,
+        withdrawal_approve_media_type=:mt,
+        withdrawal_approve_media_file_id=:mf
+    WHERE id=:i
+""")
+SQL_UPD_WD_REJECT_MSG = text("""
+    UPDATE bots
+    SET withdrawal_reject_message=:t,
+        withdrawal_reject_media_type=:mt,
+        withdrawal_reject_media_file_id=:mf
+    WHERE id=:i
+""")
+SQL_UPD_SCANLIMIT_MSG = text("""
+    UPDATE bots
+    SET scan_limit_message=:t,
+        scan_limit_message_media_type=:mt,
+        scan_limit_message_media_file_id=:mf
+    WHERE id=:i
+""")
+SQL_UPD_SCANLIMIT = text("UPDATE bots SET scan_limit_per_day=:l WHERE id=:i")
+SQL_DEL_SCAN_USAGE_USER = text("DELETE FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d")
+SQL_DEL_SCAN_USAGE_DAY = text("DELETE FROM scan_daily_usage WHERE bot_id=:b AND day=:d")
+SQL_DEL_SCANLIMIT_OVERRIDE = text("DELETE FROM scan_limit_overrides WHERE bot_id=:b AND user_id=:u")
+SQL_INS_SCANLIMIT_OVERRIDE = text("""
+    INSERT INTO scan_limit_overrides (bot_id, user_id, limit_per_day)
+    VALUES (:b, :u, :l)
+    ON CONFLICT (bot_id, user_id) DO UPDATE SET
+      limit_per_day=excluded.limit_per_day,
+      updated_at=NOW()
+""")
+SQL_UPD_SHARE = text("UPDATE bots SET affiliate_amount=:a WHERE id=:i")
+SQL_UPD_MINWD = text("UPDATE bots SET min_withdraw_amount=:a WHERE id=:i")
+SQL_UPD_LOCK = text("UPDATE bots SET lock_bot=:v WHERE id=:i")
+SQL_UPD_ADMIN_GROUP = text("UPDATE bots SET admin_group_id=:g WHERE id=:i")
+SQL_INS_SCANNER_GAME = text("""
+    INSERT INTO scanner_games (bot_id, provider, game)
+    VALUES (:bot_id, :provider, :game)
+    ON CONFLICT DO NOTHING
+""")
+SQL_DEL_SCANNER_GAMES_ALL = text("DELETE FROM scanner_games WHERE bot_id=:b")
+SQL_DEL_SCANNER_GAMES_PROVIDER = text("DELETE FROM scanner_games WHERE bot_id=:b AND provider=:p")
+SQL_UPD_PREMIUM = text("UPDATE users SET is_premium=:v, premium_until=NULL WHERE bot_id=:b AND user_id=:u")
+SQL_SEL_WITHDRAWAL = text("SELECT * FROM withdrawals WHERE id=:i")
+# Approve = satu round trip: debit hanya kalau balance cukup, dan withdrawal
+# hanya ditanda APPROVED kalau debit berjaya (masih PENDING).
+SQL_APPROVE_WD_DEBIT = text("""
+    WITH debit AS (
+        UPDATE users SET balance=balance-:a
+        WHERE bot_id=:b AND user_id=:u AND balance>=:a
+        RETURNING balance
+    ), wd AS (
+        UPDATE withdrawals
+        SET status='APPROVED',
+            approved_amount=:a,
+            processed_at=NOW(),
+            processed_by=:by
+        WHERE id=:i AND status='PENDING' AND EXISTS (SELECT 1 FROM debit)
+        RETURNING id
+    )
+    SELECT (SELECT balance FROM debit) AS balance_after,
+           EXISTS (SELECT 1 FROM wd) AS approved
+""")
+SQL_SEL_BALANCE = text("SELECT balance FROM users WHERE bot_id=:b AND user_id=:u")
+SQL_UPD_WD_REJECTED = text("""
+    UPDATE withdrawals
+    SET status='REJECTED',
+        processed_at=NOW(),
+        processed_by=:by
+    WHERE id=:i AND status='PENDING'
+    RETURNING id
+""")
+# /cmd dinamik: action + user row + scan stats hari ini dalam satu round trip
+SQL_SEL_ACTION_WITH_USER = text("""
+    WITH a AS (SELECT * FROM actions WHERE bot_id=:b AND key=:k),
+         u AS (SELECT * FROM users WHERE bot_id=:b AND user_id=:u)
+    SELECT (SELECT row_to_json(a) FROM a) AS action,
+           (SELECT row_to_json(u) FROM u) AS urow,
+           (SELECT limit_per_day FROM scan_limit_overrides WHERE bot_id=:b AND user_id=:u) AS scan_override,
+           (SELECT count FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d) AS scan_used
+""")
+
+
+
+
+class WithdrawalConflict(RuntimeError):
+    """Withdrawal dah diproses oleh admin lain dalam transaction serentak (rollback)."""
 
 
 # ---------------------------
@@ -114,6 +301,130 @@ def now_local_str(fmt: str) -> str:
     return datetime.now().strftime(fmt)
 
 
+_AMT_RE = re.compile(r"^\d+(?:\.\d+)?$")
+
+# Hot-path patterns (callback/approve) - compile sekali
+_WID_RE = re.compile(r"^[0-9a-fA-F-]{20,}$")
+_WD_CB_RE = re.compile(r"wd:(ap|rj):([0-9a-fA-F-]{20,})\Z")
+_AMT_IN_TEXT_RE = re.compile(r"(\d+(?:\.\d+)?)")
+_CB_DELAY_RE = re.compile(r"^(\d+)")
+_REPLY_UID_RE = re.compile(r"UID:\s*(\d+)")  # reply_to_message.text ialah plain text (tiada tag HTML)
+_REPLY_WID_RE = re.compile(r"ID:\s*<code>([0-9a-fA-F-]+)</code>")
+_LOCK_MARK_RE = re.compile(r"<b>(?:APPROVED|REJECTED)</b>")
+
+
+def _parse_amt(s: str) -> Optional[float]:
+    """Positive amount like '30' / '1.50' -> float; anything else -> None (no raise)."""
+    s = (s or "").strip()
+    if not _AMT_RE.match(s):
+        return None
+    amt = float(s)
+    return amt if amt > 0 else None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with adaptive refill rate.
+    on_success() raises the rate slowly (additive), on_failure() cuts it (multiplicative),
+    bounded by [min_rate, max_rate].
+    """
+
+    def __init__(self, capacity: float, rate: float, min_rate: Optional[float] = None, max_rate: Optional[float] = None):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate if min_rate is not None else max(rate / 10.0, 0.1))
+        self.max_rate = float(max_rate if max_rate is not None else rate * 2.0)
+        self.tokens = float(capacity)
+        self.last_ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_ts) * self.rate)
+        self.last_ts = now
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Block until a token is available (or timeout). For worker threads, not request handlers."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait = (1.0 - self.tokens) / max(self.rate, 1e-6)
+            if deadline is not None:
+                if now >= deadline:
+                    return False
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + max(0.05, self.rate * 0.01))
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * 0.5)
+
+
+_WEBHOOK_BUCKETS: Dict[str, TokenBucket] = {}
+_WEBHOOK_BUCKETS_LOCK = threading.Lock()
+
+
+def webhook_bucket(bot_id: str) -> TokenBucket:
+    b = _WEBHOOK_BUCKETS.get(bot_id)
+    if b is None:
+        with _WEBHOOK_BUCKETS_LOCK:
+            b = _WEBHOOK_BUCKETS.get(bot_id)
+            if b is None:
+                b = _WEBHOOK_BUCKETS[bot_id] = TokenBucket(WEBHOOK_BURST, WEBHOOK_RATE, max_rate=WEBHOOK_RATE * 2)
+    return b
+
+
+_TG_SEND_BUCKETS: Dict[str, TokenBucket] = {}
+
+
+def tg_send_bucket(token: str) -> TokenBucket:
+    """Fixed-rate bucket per bot token, ~TG_SEND_RATE msg/s (Telegram cap is 30/s)."""
+    b = _TG_SEND_BUCKETS.get(token)
+    if b is None:
+        with _WEBHOOK_BUCKETS_LOCK:
+            b = _TG_SEND_BUCKETS.get(token)
+            if b is None:
+                b = _TG_SEND_BUCKETS[token] = TokenBucket(TG_SEND_RATE, TG_SEND_RATE, min_rate=TG_SEND_RATE, max_rate=TG_SEND_RATE)
+    return b
+
+
+# Telegram had ~1 msg/s per chat. Hanya outbound worker tunggu bucket ni (blocking acquire).
+_TG_CHAT_BUCKETS: Dict[Tuple[str, int], TokenBucket] = {}
+
+
+def tg_chat_bucket(token: str, chat_id) -> TokenBucket:
+    ck = (token, int(chat_id))
+    b = _TG_CHAT_BUCKETS.get(ck)
+    if b is None:
+        with _WEBHOOK_BUCKETS_LOCK:
+            b = _TG_CHAT_BUCKETS.get(ck)
+            if b is None:
+                if len(_TG_CHAT_BUCKETS) >= 10000:
+                    _TG_CHAT_BUCKETS.clear()
+                b = _TG_CHAT_BUCKETS[ck] = TokenBucket(1, 1.0, min_rate=1.0, max_rate=1.0)
+    return b
+
+
+# Bound concurrent callback handlers (DB pool + Telegram rate)
+_CB_SEM = threading.BoundedSemaphore(max(1, CB_MAX_PARALLEL))
+
+
 def _exec_ddl_multi(conn, ddl: str):
     stmts = [s.strip() for s in ddl.split(";") if s.strip()]
     for s in stmts:
@@ -405,7 +716,12 @@ def entities_to_html(text_: str, entities: Optional[list]) -> str:
 # ---------------------------
 # TELEGRAM API
 # ---------------------------
+# retry_after (saat) dari 429 terakhir dalam thread ni; 0 = call terakhir bukan 429
+_TG_LAST = threading.local()
+
+
 def tg_call(token: str, method: str, params=None, data=None, files=None):
+    _TG_LAST.retry_after = 0
     try:
         r = SESSION.post(
             TG_API.format(token=token, method=method),
@@ -424,6 +740,8 @@ def tg_call(token: str, method: str, params=None, data=None, files=None):
             desc = (js.get("description") or "").lower()
             if method in ("editMessageText", "editMessageCaption", "editMessageMedia") and "message is not modified" in desc:
                 return None
+            if js.get("error_code") == 429:
+                _TG_LAST.retry_after = int((js.get("parameters") or {}).get("retry_after") or 1)
             logger.error(f"TG Error {method}: {js}")
             return None
         return js.get("result")
@@ -432,7 +750,7 @@ def tg_call(token: str, method: str, params=None, data=None, files=None):
         return None
 
 
-def send_message(token, chat_id, text_, reply_markup=None, parse_mode="HTML", reply_to_message_id=None):
+def send_message(token, chat_id, text_, reply_markup=None, parse_mode="HTML", reply_to_message_id=None, reply_markup_json: Optional[str] = None):
     if not text_:
         return None
     text_ = sanitize_telegram_html(text_) if parse_mode == "HTML" else text_
@@ -444,11 +762,70 @@ def send_message(token, chat_id, text_, reply_markup=None, parse_mode="HTML", re
     }
     if reply_to_message_id:
         data["reply_to_message_id"] = reply_to_message_id
-    if reply_markup:
+    if reply_markup_json:
+        # already serialized (template keyboards)
+        data["reply_markup"] = reply_markup_json
+    elif reply_markup:
         data["reply_markup"] = json.dumps(reply_markup)
     return tg_call(token, "sendMessage", data=data)
 
 
+# Fire-and-forget sendMessage: item masuk queue, N worker thread hantar guna SESSION
+# (keep-alive pool yang sama). Worker start lazy bila item pertama masuk.
+_OUT_Q: "queue.Queue[tuple]" = queue.Queue(maxsize=OUT_QUEUE_MAX)
+_OUT_THREADS: List[threading.Thread] = []
+_OUT_START_LOCK = threading.Lock()
+
+
+OUT_MAX_ATTEMPTS = 3
+
+
+def _sender_loop() -> None:
+    while True:
+        token, chat_id, text_, reply_markup, reply_markup_json, parse_mode, attempt = _OUT_Q.get()
+        try:
+            # pace sebelum HTTP: 1/s per chat, TG_SEND_RATE/s per bot token
+            tg_chat_bucket(token, chat_id).acquire()
+            if TG_SEND_RATE > 0:
+                tg_send_bucket(token).acquire()
+            res = send_message(token, chat_id, text_, reply_markup=reply_markup, parse_mode=parse_mode, reply_markup_json=reply_markup_json)
+            retry_after = getattr(_TG_LAST, "retry_after", 0)
+            if res is None and retry_after and attempt + 1 < OUT_MAX_ATTEMPTS:
+                time.sleep(min(retry_after, 60))
+                try:
+                    _OUT_Q.put_nowait((token, chat_id, text_, reply_markup, reply_markup_json, parse_mode, attempt + 1))
+                except queue.Full:
+                    logger.warning(f"outbound queue full, drop 429 retry chat={chat_id}")
+        except Exception as e:
+            logger.error(f"outbound send failed chat={chat_id}: {e}")
+        finally:
+            _OUT_Q.task_done()
+
+
+def _ensure_senders() -> None:
+    if _OUT_THREADS:
+        return
+    with _OUT_START_LOCK:
+        if _OUT_THREADS:
+            return
+        for i in range(max(1, OUT_WORKERS)):
+            t = threading.Thread(target=_sender_loop, name=f"tg-out-{i}", daemon=True)
+            t.start()
+            _OUT_THREADS.append(t)
+
+
+def send_message_async(token, chat_id, text_, reply_markup=None, parse_mode="HTML", reply_markup_json: Optional[str] = None) -> bool:
+    """Queue a sendMessage; False if the queue is full (caller decides whether to send inline)."""
+    if not text_:
+        return True
+    _ensure_senders()
+    try:
+        _OUT_Q.put_nowait((token, chat_id, text_, reply_markup, reply_markup_json, parse_mode, 0))
+        return True
+    except queue.Full:
+        return False
+
+
 # -------------------------------------------------------------------
 # Backward-compatible Telegram helper aliases
 # Some older parts of the code call tg_send_message / tg_send_photo etc.
@@ -476,7 +853,7 @@ def delete_message(token, chat_id, message_id):
     return tg_call(token, "deleteMessage", data=data)
 
 
-def edit_message(token, chat_id, message_id, text_, reply_markup=None, parse_mode="HTML"):
+def edit_message(token, chat_id, message_id, text_, reply_markup=None, parse_mode="HTML", reply_markup_json: Optional[str] = None):
     text_ = sanitize_telegram_html(text_) if parse_mode == "HTML" else text_
     data = {
         "chat_id": chat_id,
@@ -485,11 +862,22 @@ def edit_message(token, chat_id, message_id, text_, reply_markup=None, parse_mod
         "parse_mode": parse_mode,
         "disable_web_page_preview": True,
     }
-    if reply_markup:
+    if reply_markup_json:
+        # already serialized (static keyboards)
+        data["reply_markup"] = reply_markup_json
+    elif reply_markup:
         data["reply_markup"] = json.dumps(reply_markup)
     return tg_call(token, "editMessageText", data=data)
 
 
+def edit_reply_markup(token, chat_id, message_id, reply_markup=None):
+    """Tukar inline keyboard sahaja (text mesej kekal)."""
+    data = {"chat_id": chat_id, "message_id": message_id}
+    if reply_markup:
+        data["reply_markup"] = json.dumps(reply_markup)
+    return tg_call(token, "editMessageReplyMarkup", data=data)
+
+
 def edit_caption(token, chat_id, message_id, caption_, reply_markup=None, parse_mode="HTML"):
     caption_ = sanitize_telegram_html(caption_) if parse_mode == "HTML" else caption_
     caption_ = _trim(caption_, TG_MAX_CAPTION)
@@ -559,6 +947,29 @@ def answer_callback(token, callback_query_id, text_=None, show_alert=False):
     return tg_call(token, "answerCallbackQuery", data=data)
 
 
+_ACK_BODY_TPL = '{"callback_query_id":"%s"}'
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def answer_callback_fast(token, callback_query_id) -> None:
+    """Bare ack (no text/alert): body dari template, tanpa dict + json.dumps."""
+    cq_id = str(callback_query_id)
+    if not cq_id.isdigit():
+        answer_callback(token, cq_id)
+        return
+    try:
+        r = SESSION.post(
+            TG_API.format(token=token, method="answerCallbackQuery"),
+            data=(_ACK_BODY_TPL % cq_id).encode(),
+            headers=_JSON_HEADERS,
+            timeout=5,
+        )
+        if r.status_code != 200:
+            logger.error(f"TG Error answerCallbackQuery: status={r.status_code} body={r.text[:250]}")
+    except Exception as e:
+        logger.error(f"TG Exception answerCallbackQuery: {e}")
+
+
 # TEXT/BTN HELPERS
 # ---------------------------
 DATE_FMT = "%d/%m/%Y"
@@ -663,9 +1074,20 @@ def parse_buttons(text_: str, share_inline_query: Optional[str] = None) -> Tuple
     return "\n".join(visible).strip(), ({"inline_keyboard": kb} if kb else None)
 
 
+_DASH = "-"
+
+# Sama output dengan html.escape(quote=True), satu pass str.translate
+_HTML_TBL = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
 def _h(val) -> str:
     # escape placeholder values sahaja (template text admin masih boleh guna HTML)
-    return html.escape("" if val is None else str(val), quote=True)
+    return "" if val is None else str(val).translate(_HTML_TBL)
+
+
+def _esc(s) -> str:
+    """Escaped value, or '-' when empty."""
+    return str(s).translate(_HTML_TBL) if s else _DASH
 
 
 def _normalize_url(url: str) -> str:
@@ -827,19 +1249,33 @@ def replace_scanner_games(conn: sa.engine.Connection, bot_id: str, provider: str
     )
     if not games:
         return 0
+    # Bulk path: COPY into a temp table (one stream, no per-row bind params), then one INSERT..SELECT.
+    conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS t_games (game TEXT) ON COMMIT DROP"))
+    conn.execute(text("TRUNCATE t_games"))
+    buf = StringIO("\n".join(_copy_escape(g) for g in games))
+    cur = conn.connection.cursor()
+    try:
+        cur.copy_expert("COPY t_games (game) FROM STDIN", buf)
+    finally:
+        cur.close()
     conn.execute(
         text(
             """
             INSERT INTO scanner_games (bot_id, provider, game)
-            VALUES (:bot_id, :provider, :game)
+            SELECT :bot_id, :provider, game FROM t_games
             ON CONFLICT DO NOTHING
             """
         ),
-        [{"bot_id": bot_id, "provider": provider, "game": g} for g in games],
+        {"bot_id": bot_id, "provider": provider},
     )
     return len(games)
 
 
+def _copy_escape(v: str) -> str:
+    # COPY text format: backslash, tab, CR/LF must be escaped
+    return v.replace("\\", "\\\\").replace("\t", "\\t").replace("\r", "\\r").replace("\n", "\\n")
+
+
 def get_scanner_games(conn: sa.engine.Connection, bot_id: str, provider: str) -> List[str]:
     provider = norm_provider(provider)
     rows = conn.execute(
@@ -894,6 +1330,65 @@ def scanner_check_and_touch_cooldown(
     return 0
 
 
+# "Adakah key ni scanner provider?" - cache per process (30s). Kebanyakan cb: key
+# bukan scanner, jadi hit False = gate skip tanpa DB langsung.
+SCANNER_KEY_CACHE_TTL = 30
+_SCANNER_KEY_CACHE: Dict[Tuple[str, str], Tuple[float, bool]] = {}
+_SCANNER_KEY_LOCK = threading.Lock()
+
+SQL_IS_SCANNER_KEY = text("""
+    SELECT EXISTS (SELECT 1 FROM scanner_media WHERE bot_id=:b AND provider=:p)
+        OR EXISTS (SELECT 1 FROM scanner_games WHERE bot_id=:b AND provider=:p)
+""")
+
+
+def is_scanner_key(bot_id: str, provider: str) -> bool:
+    ck = (str(bot_id), norm_provider(provider))
+    if not ck[1]:
+        return False
+    hit = _SCANNER_KEY_CACHE.get(ck)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    with engine.connect() as conn:
+        val = bool(conn.execute(SQL_IS_SCANNER_KEY, {"b": ck[0], "p": ck[1]}).scalar())
+    with _SCANNER_KEY_LOCK:
+        if len(_SCANNER_KEY_CACHE) >= 4096:
+            _SCANNER_KEY_CACHE.clear()
+        _SCANNER_KEY_CACHE[ck] = (time.monotonic() + SCANNER_KEY_CACHE_TTL, val)
+    return val
+
+
+def invalidate_scanner_keys(bot_id: str) -> None:
+    bid = str(bot_id)
+    with _SCANNER_KEY_LOCK:
+        for ck in [k for k in _SCANNER_KEY_CACHE if k[0] == bid]:
+            _SCANNER_KEY_CACHE.pop(ck, None)
+
+
+# Cooldown scanner dalam memory: tekan berulang dalam window tak sentuh DB langsung.
+# DB (scanner_cooldowns) masih jadi sumber kebenaran untuk tekan pertama / lepas restart.
+_SCAN_COOLDOWN: Dict[Tuple[str, int, str], float] = {}
+_SCAN_COOLDOWN_LOCK = threading.Lock()
+
+
+def scanner_cooldown_remaining(bot_id: str, user_id: int, provider: str) -> int:
+    """Remaining seconds from the in-process map (0 = unknown / expired)."""
+    until = _SCAN_COOLDOWN.get((str(bot_id), int(user_id), norm_provider(provider)))
+    if not until:
+        return 0
+    left = until - time.monotonic()
+    return int(left + 0.999) if left > 0 else 0
+
+
+def scanner_cooldown_mark(bot_id: str, user_id: int, provider: str, seconds: float) -> None:
+    now = time.monotonic()
+    with _SCAN_COOLDOWN_LOCK:
+        if len(_SCAN_COOLDOWN) >= 100_000:
+            for ck in [k for k, v in _SCAN_COOLDOWN.items() if v <= now]:
+                _SCAN_COOLDOWN.pop(ck, None)
+        _SCAN_COOLDOWN[(str(bot_id), int(user_id), norm_provider(provider))] = now + seconds
+
+
 # ---------------------------
 # Scanner daily limit (per day)
 # ---------------------------
@@ -922,6 +1417,19 @@ def _find_user_id_by_username(conn, bot_id: str, username_no_at: str) -> Optiona
     return int(row["user_id"]) if row and row.get("user_id") is not None else None
 
 
+def _resolve_scan_limit(bot_row: dict, override) -> Optional[int]:
+    """Pick user override (if any) else bot setting."""
+    if override is not None:
+        return int(override)
+    lim = bot_row.get("scan_limit_per_day")
+    if lim is None:
+        return None
+    try:
+        return int(lim)
+    except Exception:
+        return None
+
+
 def get_scan_limit_for_user(conn, bot_row: dict, bot_id: str, user_id: int) -> Optional[int]:
     """Return limit per day for user. Priority: override table, then bot setting."""
     try:
@@ -933,13 +1441,7 @@ def get_scan_limit_for_user(conn, bot_row: dict, bot_id: str, user_id: int) -> O
             return int(r["limit_per_day"])
     except Exception:
         pass
-    lim = bot_row.get("scan_limit_per_day")
-    if lim is None:
-        return None
-    try:
-        return int(lim)
-    except Exception:
-        return None
+    return _resolve_scan_limit(bot_row, None)
 
 
 def scan_daily_touch_or_block(conn, bot_row: dict, bot_id: str, user_id: int) -> Tuple[bool, int, Optional[int]]:
@@ -982,6 +1484,58 @@ def scan_daily_touch_or_block(conn, bot_row: dict, bot_id: str, user_id: int) ->
     return False, used, lim_i
 
 
+SQL_SCAN_GATE = text("""
+    WITH f AS (
+        SELECT (EXISTS (SELECT 1 FROM scanner_media WHERE bot_id=:b AND provider=:p)
+                OR EXISTS (SELECT 1 FROM scanner_games WHERE bot_id=:b AND provider=:p)) AS is_scanner,
+               COALESCE(
+                   (SELECT limit_per_day FROM scan_limit_overrides WHERE bot_id=:b AND user_id=:u),
+                   CAST(:bot_lim AS INTEGER)
+               ) AS lim
+    ), ins AS (
+        INSERT INTO scan_daily_usage (bot_id, user_id, day, count)
+        SELECT :b, :u, :d, 1 FROM f WHERE f.is_scanner AND f.lim > 0
+        ON CONFLICT (bot_id, user_id, day) DO UPDATE
+          SET count = scan_daily_usage.count + 1,
+              updated_at = NOW()
+          WHERE scan_daily_usage.count < (SELECT lim FROM f)
+        RETURNING count
+    )
+    SELECT f.is_scanner, f.lim,
+           (SELECT count FROM ins) AS used_after,
+           (SELECT count FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d) AS used_before
+    FROM f
+""")
+
+
+def scan_daily_gate(conn, bot_row: dict, bot_id: str, user_id: int, provider: str) -> Tuple[bool, bool, int, Optional[int]]:
+    """
+    Scanner check + daily limit touch dalam satu round trip.
+    Returns (is_scanner, allowed, used_after, limit) - sama makna macam scan_daily_touch_or_block.
+    """
+    r = conn.execute(
+        SQL_SCAN_GATE,
+        {
+            "b": bot_id,
+            "u": int(user_id),
+            "p": norm_provider(provider),
+            "d": _today_local_date(),
+            "bot_lim": _resolve_scan_limit(bot_row, None),
+        },
+    ).mappings().first()
+    if not r or not r["is_scanner"]:
+        return False, True, 0, None
+    lim = r["lim"]
+    if lim is None:
+        return True, True, 0, None
+    lim_i = int(lim)
+    if lim_i <= 0:
+        return True, True, 0, lim_i
+    if r["used_after"] is not None:
+        return True, True, int(r["used_after"]), lim_i
+    return True, False, int(r["used_before"] or lim_i), lim_i
+
+
 def scan_daily_get_stats(conn, bot_row: dict, bot_id: str, user_id: int) -> Tuple[int, Optional[int], str, str]:
     """Return (used_today, limit_int_or_None, remaining_str, reset_str).
 
@@ -990,8 +1544,17 @@ def scan_daily_get_stats(conn, bot_row: dict, bot_id: str, user_id: int) -> Tupl
     - remaining_str: '∞' if unlimited else remaining count as string.
     - reset_str: next reset timestamp string in local time.
     """
-    # limit
     lim = get_scan_limit_for_user(conn, bot_row, bot_id, user_id)
+    day = _today_local_date()
+    cur = conn.execute(
+        text("SELECT count FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d"),
+        {"b": bot_id, "u": int(user_id), "d": day},
+    ).mappings().first()
+    return scan_daily_stats_from_values(lim, (cur or {}).get("count"))
+
+
+def scan_daily_stats_from_values(lim: Optional[int], used_raw) -> Tuple[int, Optional[int], str, str]:
+    """Same output as scan_daily_get_stats, from already-fetched limit + today's count."""
     lim_i: Optional[int] = None
     if lim is not None:
         try:
@@ -999,12 +1562,7 @@ def scan_daily_get_stats(conn, bot_row: dict, bot_id: str, user_id: int) -> Tupl
         except Exception:
             lim_i = 0
 
-    day = _today_local_date()
-    cur = conn.execute(
-        text("SELECT count FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d"),
-        {"b": bot_id, "u": int(user_id), "d": day},
-    ).mappings().first()
-    used = int((cur or {}).get("count") or 0)
+    used = int(used_raw or 0)
 
     # remaining
     if lim is None:
@@ -1030,7 +1588,7 @@ def scan_daily_get_stats(conn, bot_row: dict, bot_id: str, user_id: int) -> Tupl
     return used, lim_i, remaining, reset_str
 
 
-def apply_scan_placeholders(conn, text_: str, bot_row: dict, bot_id: str, user_id: int) -> str:
+def apply_scan_placeholders(conn, text_: str, bot_row: dict, bot_id: str, user_id: int, stats: Optional[tuple] = None) -> str:
     """Replace scan placeholders in any template text.
 
     Supported:
@@ -1038,13 +1596,17 @@ def apply_scan_placeholders(conn, text_: str, bot_row: dict, bot_id: str, user_i
     - {limit}: daily limit or 'UNLIMITED'
     - {remaining}: remaining scans today or '∞'
     - {reset}: next reset local timestamp
+
+    Pass `stats` (from scan_daily_stats_from_values) to skip the DB read.
     """
     if not text_:
         return ""
     if not any(p in text_ for p in ("{count}", "{used}", "{limit}", "{remaining}", "{reset}")):
         return text_
 
-    used, lim_i, remaining, reset_str = scan_daily_get_stats(conn, bot_row, bot_id, user_id)
+    if stats is None:
+        stats = scan_daily_get_stats(conn, bot_row, bot_id, user_id)
+    used, lim_i, remaining, reset_str = stats
 
     # limit display
     if lim_i is None:
@@ -1117,7 +1679,7 @@ def send_scanner_result(token: str, chat_id: int, firstname: str, provider: str,
 
     # give some "animation"
     try:
-        requests.post(
+        SESSION.post(
             f"https://api.telegram.org/bot{token}/sendChatAction",
             json={"chat_id": chat_id, "action": "typing"},
             timeout=10,
@@ -1214,17 +1776,70 @@ def send_scanner_result_edit(token: str, chat_id: int, message_id: int, firstnam
 
 
 def require_admin(bot_row: dict, uid: int) -> bool:
-    return is_owner(uid, bot_row) or is_admin(uid, str(bot_row["id"]))
+    if is_owner(uid, bot_row):
+        return True
+    # bot rows from get_bot_by_* carry active admin ids -> no extra query
+    admin_uids = bot_row.get("admin_uids")
+    if admin_uids is not None:
+        return int(uid) in admin_uids
+    return is_admin(uid, str(bot_row["id"]))
+
+
+# bot row + active admin ids in one query (used by require_admin)
+_BOT_SELECT = """
+    SELECT b.*,
+           ARRAY(
+             SELECT a.admin_user_id FROM admins a
+             WHERE a.bot_id = b.id AND (a.expiry_at IS NULL OR a.expiry_at > NOW())
+           ) AS admin_uids
+    FROM bots b
+"""
+SQL_SEL_BOT_BY_SECRET = text(_BOT_SELECT + " WHERE b.secret_token=:s")
+SQL_SEL_BOT_BY_ID = text(_BOT_SELECT + " WHERE b.id=:i")
+
+
+def _bot_row_dict(row):
+    if not row:
+        return None
+    d = dict(row)
+    d["admin_uids"] = frozenset(int(x) for x in (d.get("admin_uids") or ()))
+    return d
+
+
+# Short TTL cache bot row (per process). Callback path panggil get_bot_by_id()
+# berulang kali; setiap UPDATE bots / admins mesti panggil invalidate_bot_cache().
+_BOT_CACHE: Dict[str, Tuple[float, dict]] = {}
+_BOT_CACHE_LOCK = threading.Lock()
+
+
+def _bot_cache_put(row) -> None:
+    if row and BOT_CACHE_TTL > 0:
+        with _BOT_CACHE_LOCK:
+            if len(_BOT_CACHE) >= 1024:
+                _BOT_CACHE.clear()
+            _BOT_CACHE[str(row["id"])] = (time.monotonic() + BOT_CACHE_TTL, row)
+
+
+def invalidate_bot_cache(bot_id) -> None:
+    with _BOT_CACHE_LOCK:
+        _BOT_CACHE.pop(str(bot_id), None)
 
 
 def get_bot_by_secret(secret: str):
     with engine.connect() as conn:
-        return conn.execute(text("SELECT * FROM bots WHERE secret_token=:s"), {"s": secret}).mappings().first()
+        row = _bot_row_dict(conn.execute(SQL_SEL_BOT_BY_SECRET, {"s": secret}).mappings().first())
+    _bot_cache_put(row)
+    return row
 
 
 def get_bot_by_id(bot_id: str):
+    hit = _BOT_CACHE.get(str(bot_id))
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
     with engine.connect() as conn:
-        return conn.execute(text("SELECT * FROM bots WHERE id=:i"), {"i": bot_id}).mappings().first()
+        row = _bot_row_dict(conn.execute(SQL_SEL_BOT_BY_ID, {"i": bot_id}).mappings().first())
+    _bot_cache_put(row)
+    return row
 
 
 def get_bot_by_token(token_: str):
@@ -1246,7 +1861,13 @@ def list_bots_by_owner(owner_id: int):
         ).mappings().all()
 
 
-def get_user_row(bot_id: str, uid: int):
+def get_user_row(bot_id: str, uid: int, conn=None):
+    # conn optional: reuse caller's connection (satu checkout untuk beberapa read)
+    if conn is not None:
+        return conn.execute(
+            text("SELECT * FROM users WHERE bot_id=:b AND user_id=:u"),
+            {"b": bot_id, "u": uid},
+        ).mappings().first()
     with engine.connect() as conn:
         return conn.execute(
             text("SELECT * FROM users WHERE bot_id=:b AND user_id=:u"),
@@ -1547,6 +2168,7 @@ def add_admin(bot_id: str, admin_user_id: int, added_by: int, days: Optional[int
             """),
             {"b": bot_id, "u": int(admin_user_id), "e": expiry_at, "by": int(added_by)},
         )
+    invalidate_bot_cache(bot_id)
 
 
 def del_admin(bot_id: str, admin_user_id: int) -> bool:
@@ -1555,6 +2177,7 @@ def del_admin(bot_id: str, admin_user_id: int) -> bool:
             text("DELETE FROM admins WHERE bot_id=:b AND admin_user_id=:u"),
             {"b": bot_id, "u": int(admin_user_id)},
         )
+    invalidate_bot_cache(bot_id)
     return res.rowcount > 0
 
 
@@ -1586,12 +2209,38 @@ def enqueue_broadcast_task(payload: dict) -> None:
 
 
 
-def enqueue_action_task(payload: dict, delay_seconds: int) -> None:
+# CloudTasksClient buka gRPC channel - bina sekali per process, bukan per delayed callback
+_ACTION_TASKS_CLIENT = None
+_ACTION_TASKS_LOCK = threading.Lock()
+
+
+def _action_tasks_client():
+    global _ACTION_TASKS_CLIENT
+    if _ACTION_TASKS_CLIENT is None:
+        with _ACTION_TASKS_LOCK:
+            if _ACTION_TASKS_CLIENT is None:
+                client = tasks_v2.CloudTasksClient()
+                _ACTION_TASKS_CLIENT = (client, client.queue_path(GCP_PROJECT, TASKS_LOCATION, TASKS_QUEUE))
+    return _ACTION_TASKS_CLIENT
+
+
+def pack_action_task(bot_id: str, chat_id, user_id, message_id, key: str) -> bytes:
+    """Compact JSON body for /task/action (no whitespace; same keys task_action() reads)."""
+    return json.dumps(
+        {"bot_id": bot_id, "chat_id": chat_id, "user_id": user_id, "message_id": message_id, "key": key},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+def enqueue_action_task(payload, delay_seconds: int) -> None:
     """
     Cloud Tasks scheduled action for delayed callbacks.
+    payload: bytes dari pack_action_task() (atau dict, untuk caller lama).
     """
-    client = tasks_v2.CloudTasksClient()
-    parent = client.queue_path(GCP_PROJECT, TASKS_LOCATION, TASKS_QUEUE)
+    client, parent = _action_tasks_client()
+    if not isinstance(payload, (bytes, bytearray)):
+        payload = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
 
     # schedule_time uses UTC Timestamp
     from google.protobuf import timestamp_pb2
@@ -1605,10 +2254,51 @@ def enqueue_action_task(payload: dict, delay_seconds: int) -> None:
             "http_method": tasks_v2.HttpMethod.POST,
             "url": f"{PUBLIC_BASE_URL}/task/action",
             "headers": {"Content-Type": "application/json", "X-Tasks-Secret": TASKS_SECRET},
-            "body": json.dumps(payload).encode("utf-8"),
+            "body": bytes(payload),
         }
     }
     client.create_task(request={"parent": parent, "task": task})
+
+
+# In-process fallback untuk delayed callback: satu heap + satu scheduler thread,
+# kerja sebenar jalan dalam worker pool yang bounded (bukan 1 Timer thread / callback).
+_DELAY_EXEC = ThreadPoolExecutor(max_workers=DELAY_MAX_WORKERS, thread_name_prefix="delayed")
+_DELAY_HEAP: list = []  # (due_monotonic, seq, fn)
+_DELAY_SEQ = itertools.count()
+_DELAY_CV = threading.Condition()
+_DELAY_THREAD: Optional[threading.Thread] = None
+
+
+def _delay_loop() -> None:
+    while True:
+        with _DELAY_CV:
+            while not _DELAY_HEAP:
+                _DELAY_CV.wait()
+            due, _, fn = _DELAY_HEAP[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                _DELAY_CV.wait(wait)
+                continue
+            heapq.heappop(_DELAY_HEAP)
+        try:
+            _DELAY_EXEC.submit(fn)
+        except Exception as e:
+            logger.error(f"[DELAY] submit failed: {e}")
+
+
+def schedule_later(delay_seconds: float, fn) -> bool:
+    """Run fn() after delay_seconds on the shared scheduler. False if the queue is full."""
+    global _DELAY_THREAD
+    with _DELAY_CV:
+        if len(_DELAY_HEAP) >= DELAY_MAX_PENDING:
+            return False
+        if _DELAY_THREAD is None:
+            # start lazily (selepas gunicorn fork)
+            _DELAY_THREAD = threading.Thread(target=_delay_loop, name="delay-sched", daemon=True)
+            _DELAY_THREAD.start()
+        heapq.heappush(_DELAY_HEAP, (time.monotonic() + max(0.0, float(delay_seconds or 0)), next(_DELAY_SEQ), fn))
+        _DELAY_CV.notify()
+    return True
 # ---------------------------
 # SETTINGS UI HELPERS
 # ---------------------------
@@ -1643,12 +2333,37 @@ def get_callbacks_page(bot_id: str, page: int, page_size: int):
     return int(total), rows
 
 
+# Double-click 🗑: key yang baru dibuang (5s) terus jawab "not found" tanpa DB.
+# actions_upsert() buang entry supaya key yang ditambah semula boleh dipadam.
+RECENT_DELETE_TTL = 5.0
+_RECENT_DELETES: Dict[Tuple[str, str], float] = {}
+_RECENT_DELETES_LOCK = threading.Lock()
+
+
 def delete_callback(bot_id: str, key: str) -> bool:
-    with engine.begin() as conn:
-        res = conn.execute(
-            text("DELETE FROM actions WHERE bot_id=:b AND key=:k"),
-            {"b": bot_id, "k": key},
-        )
+    ck = (str(bot_id), str(key))
+    now = time.monotonic()
+    # check + reserve bawah lock sebelum DELETE - double-click tak jalan dua DELETE
+    with _RECENT_DELETES_LOCK:
+        until = _RECENT_DELETES.get(ck)
+        if until and until > now:
+            return False
+        if len(_RECENT_DELETES) >= 4096:
+            for k in [k for k, v in _RECENT_DELETES.items() if v <= now]:
+                _RECENT_DELETES.pop(k, None)
+        _RECENT_DELETES[ck] = now + RECENT_DELETE_TTL
+    try:
+        with engine.begin() as conn:
+            res = conn.execute(
+                text("DELETE FROM actions WHERE bot_id=:b AND key=:k"),
+                {"b": bot_id, "k": key},
+            )
+    except Exception:
+        # DELETE gagal - lepaskan reservation supaya admin boleh cuba semula
+        with _RECENT_DELETES_LOCK:
+            _RECENT_DELETES.pop(ck, None)
+        raise
+    actions_invalidate(bot_id, key)
     return res.rowcount > 0
 
 
@@ -2069,7 +2784,7 @@ def build_settings_keyboard(page: int, pages: int, cat: Optional[str] = None):
     if cat:
         return build_settings_keyboard_by_category(cat, page, pages)
     return build_settings_keyboard_full(page, pages)
-def send_or_edit_settings_panel(bot_row: dict, chat_id: int, uid: int, page: int = 1, edit_ctx: Optional[dict] = None, cat: Optional[str] = None):
+def send_or_edit_settings_panel(bot_row: dict, chat_id: int, uid: int, page: int = 1, edit_ctx: Optional[dict] = None, cat: Optional[str] = None, edit_message_id: Optional[int] = None):
     bot_id = str(bot_row["id"])
     stats = get_bot_stats(bot_id)
     cb_total, cb_rows = get_callbacks_page(bot_id, page, SETTINGS_CB_PAGE_SIZE)
@@ -2079,8 +2794,11 @@ def send_or_edit_settings_panel(bot_row: dict, chat_id: int, uid: int, page: int
     kb = build_settings_keyboard(page, pages, cat=cat)
 
     token = bot_row["token"]
-    if edit_ctx and edit_ctx.get("message_id"):
-        edit_message(token, chat_id, edit_ctx["message_id"], text_panel, reply_markup=kb, parse_mode="HTML")
+    # edit_ctx={"message_id": ...} kekal untuk caller lama; edit_message_id lebih ringan
+    if not edit_message_id and edit_ctx:
+        edit_message_id = edit_ctx.get("message_id")
+    if edit_message_id:
+        edit_message(token, chat_id, edit_message_id, text_panel, reply_markup=kb, parse_mode="HTML")
     else:
         send_message(token, chat_id, text_panel, reply_markup=kb, parse_mode="HTML")
 
@@ -2670,6 +3388,83 @@ def process_withdraw(bot_row, chat_id, user, text_msg):
         send_message(token, bot_row["admin_group_id"], rpt, reply_markup=kb, parse_mode="HTML")
 
 
+# Static keyboards (build sekali)
+_EMPTY_KB = {"inline_keyboard": []}
+_EMPTY_KB_JSON = json.dumps(_EMPTY_KB, separators=(",", ":"))
+_KB_BACK_MENU_SCANNER = {"inline_keyboard": [[{"text": "⬅️ Kembali", "callback_data": "cb:menuscanner"}]]}
+
+
+def _stamp_and_lock_admin_message(token: str, chat_id, message_id, from_user: dict, cur_text: str, status_html: str, keep_kb: Optional[dict] = None) -> Optional[str]:
+    """
+    Tambah status (APPROVED/REJECTED + By/At) pada mesej admin dan buang butang
+    supaya request tak boleh di-approve/reject dua kali.
+    keep_kb: mesej gabungan (banyak UID) - stamp satu baris, butang UID lain kekal.
+    Pulangkan text yang ditulis (None kalau gagal).
+    """
+    if not chat_id or not message_id:
+        return None
+    try:
+        admin_id = from_user.get("id")
+        admin_name = from_user.get("first_name") or "Admin"
+        admin_user = from_user.get("username")
+        who = f"@{admin_user}" if admin_user else f"<a href='tg://user?id={admin_id}'>{html.escape(admin_name)}</a>"
+        stamp = now_local_str("%Y-%m-%d %H:%M:%S")
+        cur = cur_text or ""
+        if keep_kb:
+            cur = cur + f"\n{status_html} By: {who} ({stamp})"
+            edit_message(token, chat_id, message_id, cur, reply_markup=keep_kb, parse_mode="HTML")
+            return cur
+        if not _LOCK_MARK_RE.search(cur):
+            cur = cur + f"\n\n{status_html}\nBy: {who}\nAt: {stamp}"
+        edit_message(token, chat_id, message_id, cur, parse_mode="HTML", reply_markup_json=_EMPTY_KB_JSON)
+        return cur
+    except Exception:
+        logger.exception(f"Failed to update admin message ({status_html})")
+        return None
+
+
+# State mesej premium admin (per process): UID yang dah diproses + text terakhir yang kita
+# tulis. Keyboard/text dalam callback ialah snapshot masa tekan - dua admin tekan serentak
+# akan overwrite satu sama lain. Semua edit mesej yang sama disirikan bawah lock ni.
+ADMIN_MSG_STATE_TTL = 6 * 3600
+_ADMIN_MSG_STATE: Dict[Tuple[int, int], Dict] = {}
+_ADMIN_MSG_LOCK = threading.Lock()
+
+
+def _admin_msg_claim(chat_id, message_id, uid: int) -> bool:
+    """Reserve uid on this admin message; False if someone already handled it."""
+    ck = (int(chat_id or 0), int(message_id or 0))
+    now = time.monotonic()
+    with _ADMIN_MSG_LOCK:
+        st = _ADMIN_MSG_STATE.get(ck)
+        if st is None or st["until"] <= now:
+            if len(_ADMIN_MSG_STATE) >= 4096:
+                for k in [k for k, v in _ADMIN_MSG_STATE.items() if v["until"] <= now]:
+                    _ADMIN_MSG_STATE.pop(k, None)
+            st = _ADMIN_MSG_STATE[ck] = {"done": set(), "text": None, "until": now + ADMIN_MSG_STATE_TTL}
+        if uid in st["done"]:
+            return False
+        st["done"].add(uid)
+        return True
+
+
+def _admin_msg_stamp(token: str, chat_id, message_id, from_user: dict, cq: dict, cq_message_text: str, uid: int, status_html: str) -> None:
+    """Stamp result for uid; combined message keeps rows of UIDs not yet handled (server-side set)."""
+    ck = (int(chat_id or 0), int(message_id or 0))
+    kb_rows = ((cq.get("message") or {}).get("reply_markup") or {}).get("inline_keyboard") or []
+    with _ADMIN_MSG_LOCK:
+        st = _ADMIN_MSG_STATE.get(ck) or {"done": {uid}, "text": None}
+        done_suffixes = tuple(f":{u}" for u in st["done"])
+        other_rows = [r for r in kb_rows if not any((b.get("callback_data") or "").endswith(done_suffixes) for b in r)]
+        pending_other = any((b.get("callback_data") or "").startswith(("adm:ap:", "adm:rj:")) for r in other_rows for b in r)
+        keep_kb = {"inline_keyboard": other_rows} if pending_other else None
+        if keep_kb or st.get("text"):
+            status_html = f"{status_html} <code>{uid}</code>"
+        new_text = _stamp_and_lock_admin_message(token, chat_id, message_id, from_user, st.get("text") or cq_message_text, status_html, keep_kb=keep_kb)
+        if new_text is not None and ck in _ADMIN_MSG_STATE:
+            _ADMIN_MSG_STATE[ck]["text"] = new_text
+
+
 # ---------------------------
 # COMMAND PARSING + ACTIONS
 # ---------------------------
@@ -2684,12 +3479,81 @@ def parse_command_name(text_msg: str) -> str:
     return cmd.lower()
 
 
+_DELAY_ARG_RE = re.compile(r"delay=(\d+)")
+
+
+def split_command(text_msg: str):
+    """
+    Tokenize command message sekali sahaja.
+    Return (parts, arg_line, arg_all, extra, delay):
+      parts    = token baris pertama
+      arg_line = baris pertama tanpa command
+      arg_all  = semua text tanpa command (newline kekal)
+      extra    = baris ke-2 dan seterusnya
+      delay    = nilai delay=N pada baris pertama (0 kalau tiada)
+    """
+    text_msg = text_msg or ""
+    head, _, rest = text_msg.partition("\n")
+    parts = head.split()
+    extra = rest.strip()
+    if not parts:
+        return parts, "", text_msg.strip(), extra, 0
+    cut = text_msg.find(parts[0]) + len(parts[0])
+    arg_line = head[cut:].strip()
+    arg_all = text_msg[cut:].strip()
+    m = _DELAY_ARG_RE.search(head)
+    delay = int(m.group(1)) if m else 0
+    return parts, arg_line, arg_all, extra, delay
+
+
+# Short TTL cache untuk actions row (termasuk "tiada action" -> None).
+# actions_upsert()/delete_callback() panggil actions_invalidate().
+_ACTIONS_CACHE: Dict[Tuple[str, str], Tuple[float, object]] = {}
+_ACTIONS_CACHE_LOCK = threading.Lock()
+
+
+def actions_invalidate(bot_id: str, key: str) -> None:
+    with _ACTIONS_CACHE_LOCK:
+        _ACTIONS_CACHE.pop((str(bot_id), str(key)), None)
+
+
 def actions_get(bot_id: str, key: str):
+    ck = (str(bot_id), str(key))
+    hit = _ACTIONS_CACHE.get(ck)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
     with engine.connect() as conn:
-        return conn.execute(
+        row = conn.execute(
             text("SELECT * FROM actions WHERE bot_id=:b AND key=:k"),
             {"b": bot_id, "k": key},
         ).mappings().first()
+    if ACTIONS_CACHE_TTL > 0:
+        with _ACTIONS_CACHE_LOCK:
+            if len(_ACTIONS_CACHE) >= 4096:
+                _ACTIONS_CACHE.clear()
+            _ACTIONS_CACHE[ck] = (time.monotonic() + ACTIONS_CACHE_TTL, row)
+    return row
+
+
+def _json_col(v):
+    if v is None or isinstance(v, dict):
+        return v
+    return json.loads(v)
+
+
+def actions_get_with_user(bot_id: str, key: str, uid: int):
+    """
+    One round trip for the dynamic /cmd path: action row + user row + today's scan stats.
+    Returns (act, user_row, scan_stats) -> scan_stats feeds apply_scan_placeholders(stats=...).
+    """
+    with engine.connect() as conn:
+        row = conn.execute(
+            SQL_SEL_ACTION_WITH_USER,
+            {"b": bot_id, "k": key, "u": uid, "d": _today_local_date()},
+        ).mappings().first()
+    if not row:
+        return None, None, None
+    return _json_col(row["action"]), _json_col(row["urow"]), (row["scan_override"], row["scan_used"])
 
 
 def actions_upsert(bot_id: str, key: str, ty: str, tx: str, media_id: Optional[str], delay: int):
@@ -2700,6 +3564,9 @@ def actions_upsert(bot_id: str, key: str, ty: str, tx: str, media_id: Optional[s
             ON CONFLICT (bot_id, key) DO UPDATE SET
               type=excluded.type, text=excluded.text, media_file_id=excluded.media_file_id, delay_seconds=excluded.delay_seconds
         """), {"b": bot_id, "k": key, "ty": ty, "tx": tx, "m": media_id, "d": delay})
+    actions_invalidate(bot_id, key)
+    with _RECENT_DELETES_LOCK:
+        _RECENT_DELETES.pop((str(bot_id), str(key)), None)
 
 
 # ---------------------------
@@ -2844,11 +3711,41 @@ def task_action():
 @app.post("/telegram")
 def telegram_webhook():
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
-    bot_row = get_bot_by_secret(secret)
+    try:
+        bot_row = get_bot_by_secret(secret)
+    except _DB_CONGESTION_ERRORS:
+        # bot belum dikenal pasti; DB (pool) dikongsi semua bot -> semua bucket back off
+        if WEBHOOK_RATE > 0:
+            for b in list(_WEBHOOK_BUCKETS.values()):
+                b.on_failure()
+        raise
     if not bot_row:
         return jsonify({"ok": True}), 200
 
-    update = request.get_json(silent=True) or {}
+    if WEBHOOK_RATE <= 0:
+        return process_update(bot_row, request.get_json(silent=True) or {})
+
+    bucket = webhook_bucket(str(bot_row["id"]))
+    if not bucket.try_acquire():
+        logger.warning(f"webhook shed: bot={bot_row['id']} rate={bucket.rate:.1f}/s")
+        return "OK", 200
+
+    _DB_ERR.seen = False
+    try:
+        resp = process_update(bot_row, request.get_json(silent=True) or {})
+    except _DB_CONGESTION_ERRORS:
+        bucket.on_failure()
+        raise
+    # error DB sesak yang ditelan dalam handler tetap kira gagal
+    if getattr(_DB_ERR, "seen", False):
+        bucket.on_failure()
+    elif not (isinstance(resp, tuple) and len(resp) > 1 and resp[1] == 429):
+        # 429 (callback semaphore penuh) = neutral: jangan naikkan rate
+        bucket.on_success()
+    return resp
+
+
+def process_update(bot_row: dict, update: dict):
     token = bot_row["token"]
     bot_id = str(bot_row["id"])
 
@@ -2859,7 +3756,8 @@ def telegram_webhook():
         from_user = msg.get("from") or {}
         uid = from_user.get("id")
         text_msg = msg.get("text") or ""
-        cmd = (text_msg.split()[0] if text_msg else "").split("@")[0]
+        parts, arg_line, arg_all, extra, delay = split_command(text_msg)
+        cmd = (parts[0] if parts else "").split("@")[0]
 
         if not uid:
             return "OK", 200
@@ -2927,7 +3825,6 @@ def telegram_webhook():
             if not is_owner(uid, bot_row):
                 send_message(token, chat_id, "❌ Owner sahaja boleh /addadmin", parse_mode="HTML")
             else:
-                parts = text_msg.split()
                 if len(parts) < 2 or not parts[1].isdigit():
                     send_message(token, chat_id, "Format: <code>/addadmin 123456789</code> atau <code>/addadmin 123456789 30</code>", parse_mode="HTML")
                 else:
@@ -2940,7 +3837,6 @@ def telegram_webhook():
             if not is_owner(uid, bot_row):
                 send_message(token, chat_id, "❌ Owner sahaja boleh /deladmin", parse_mode="HTML")
             else:
-                parts = text_msg.split()
                 if len(parts) < 2 or not parts[1].isdigit():
                     send_message(token, chat_id, "Format: <code>/deladmin 123456789</code>", parse_mode="HTML")
                 else:
@@ -2957,52 +3853,59 @@ def telegram_webhook():
                 if msg.get("reply_to_message"):
                     raw = (msg["reply_to_message"].get("text") or "").strip()
                 else:
-                    parts = text_msg.split(maxsplit=1)
-                    raw = parts[1].strip() if len(parts) > 1 else ""
+                    raw = arg_all
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET join_targets=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["join_targets"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ join_targets updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setjoinmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET join_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["join_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ join_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setcontactmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET contact_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["contact_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ contact_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setpendingmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET pending_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["pending_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ pending_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setverifiedmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET verified_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["verified_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ verified_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setrejectedmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET rejected_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["rejected_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ rejected_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setgroupcontactmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET group_contact_message=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["group_contact_message"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ group_contact_message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setwithdrawmsg") and msg.get("reply_to_message"):
                 raw = (msg["reply_to_message"].get("text") or msg["reply_to_message"].get("caption") or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET withdrawal_prompt=:t WHERE id=:i"), {"t": raw, "i": bot_id})
+                    conn.execute(SQL_UPD_BOT_TEXT["withdrawal_prompt"], {"t": raw, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ withdrawal_prompt updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setwithdrawalmsg") and msg.get("reply_to_message"):
@@ -3011,13 +3914,8 @@ def telegram_webhook():
                 mt, mid, txt = save_content_from_reply(rep)
                 raw = (txt or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("""
-                        UPDATE bots
-                        SET withdrawal_approve_message=:t,
-                            withdrawal_approve_media_type=:mt,
-                            withdrawal_approve_media_file_id=:mf
-                        WHERE id=:i
-                    """), {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                    conn.execute(SQL_UPD_WD_APPROVE_MSG, {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ withdrawal APPROVE message updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/setwithdrawalreject") and msg.get("reply_to_message"):
@@ -3026,13 +3924,8 @@ def telegram_webhook():
                 mt, mid, txt = save_content_from_reply(rep)
                 raw = (txt or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text("""
-                        UPDATE bots
-                        SET withdrawal_reject_message=:t,
-                            withdrawal_reject_media_type=:mt,
-                            withdrawal_reject_media_file_id=:mf
-                        WHERE id=:i
-                    """), {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                    conn.execute(SQL_UPD_WD_REJECT_MSG, {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ withdrawal REJECT message updated.", parse_mode="HTML")
 
 
@@ -3044,7 +3937,6 @@ def telegram_webhook():
                 # /setscanlimit reset         -> reset today's usage (all users)
                 # /setscanlimit reset @user   -> reset today's usage for a user
                 # /setscanlimit del @user     -> delete override for a user
-                parts = (text_msg or "").split()
                 arg1 = parts[1].strip() if len(parts) >= 2 else ""
                 arg2 = parts[2].strip() if len(parts) >= 3 else ""
 
@@ -3078,7 +3970,8 @@ def telegram_webhook():
 
                 if a1 in ("off", "0", "unlimited", "none"):
                     with engine.begin() as conn:
-                        conn.execute(text("UPDATE bots SET scan_limit_per_day=NULL WHERE id=:i"), {"i": bot_id})
+                        conn.execute(SQL_UPD_SCANLIMIT, {"l": None, "i": bot_id})
+                    invalidate_bot_cache(bot_id)
                     send_message(token, chat_id, "✅ Scan limit OFF (unlimited).", parse_mode="HTML")
                     return "OK", 200
 
@@ -3088,14 +3981,14 @@ def telegram_webhook():
                         tgt_id = _resolve_target_user_id(conn, arg2) if arg2 else None
                         if tgt_id:
                             res = conn.execute(
-                                text("DELETE FROM scan_daily_usage WHERE bot_id=:b AND user_id=:u AND day=:d"),
+                                SQL_DEL_SCAN_USAGE_USER,
                                 {"b": bot_id, "u": int(tgt_id), "d": day},
                             )
                             deleted = int(getattr(res, "rowcount", 0) or 0)
                             send_message(token, chat_id, f"✅ Reset scan usage hari ini untuk <code>{tgt_id}</code> (deleted {deleted}).", parse_mode="HTML")
                         else:
                             res = conn.execute(
-                                text("DELETE FROM scan_daily_usage WHERE bot_id=:b AND day=:d"),
+                                SQL_DEL_SCAN_USAGE_DAY,
                                 {"b": bot_id, "d": day},
                             )
                             deleted = int(getattr(res, "rowcount", 0) or 0)
@@ -3112,7 +4005,7 @@ def telegram_webhook():
                             send_message(token, chat_id, "❌ Username tak jumpa dalam DB. Pastikan user pernah /start bot.", parse_mode="HTML")
                             return "OK", 200
                         res = conn.execute(
-                            text("DELETE FROM scan_limit_overrides WHERE bot_id=:b AND user_id=:u"),
+                            SQL_DEL_SCANLIMIT_OVERRIDE,
                             {"b": bot_id, "u": int(tgt_id)},
                         )
                         deleted = int(getattr(res, "rowcount", 0) or 0)
@@ -3134,17 +4027,12 @@ def telegram_webhook():
                         if not tgt_id:
                             send_message(token, chat_id, "❌ Username tak jumpa dalam DB. Pastikan user pernah /start bot.", parse_mode="HTML")
                             return "OK", 200
-                        conn.execute(text('''
-                            INSERT INTO scan_limit_overrides (bot_id, user_id, limit_per_day)
-                            VALUES (:b, :u, :l)
-                            ON CONFLICT (bot_id, user_id) DO UPDATE SET
-                              limit_per_day=excluded.limit_per_day,
-                              updated_at=NOW()
-                        '''), {"b": bot_id, "u": int(tgt_id), "l": int(lim_i)})
+                        conn.execute(SQL_INS_SCANLIMIT_OVERRIDE, {"b": bot_id, "u": int(tgt_id), "l": int(lim_i)})
                     send_message(token, chat_id, f"✅ Set scan limit user <code>{tgt_id}</code>: <b>{lim_i}</b>/hari", parse_mode="HTML")
                 else:
                     with engine.begin() as conn:
-                        conn.execute(text("UPDATE bots SET scan_limit_per_day=:l WHERE id=:i"), {"l": int(lim_i), "i": bot_id})
+                        conn.execute(SQL_UPD_SCANLIMIT, {"l": int(lim_i), "i": bot_id})
+                    invalidate_bot_cache(bot_id)
                     send_message(token, chat_id, f"✅ Set scan limit GLOBAL: <b>{lim_i}</b>/hari", parse_mode="HTML")
                 return "OK", 200
 
@@ -3155,48 +4043,39 @@ def telegram_webhook():
                 mt, mid, txt = save_content_from_reply(rep)
                 raw = (txt or "").strip()
                 with engine.begin() as conn:
-                    conn.execute(text('''
-                        UPDATE bots
-                        SET scan_limit_message=:t,
-                            scan_limit_message_media_type=:mt,
-                            scan_limit_message_media_file_id=:mf
-                        WHERE id=:i
-                    '''), {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                    conn.execute(SQL_UPD_SCANLIMIT_MSG, {"t": raw, "mt": mt, "mf": mid, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ scan_limit message updated.", parse_mode="HTML")
 
 
 
             elif text_msg.startswith("/setshareamt"):
                 # /setshareamt 1.00  (RM per 1 click share)
-                parts = (text_msg or "").split()
                 if len(parts) < 2:
                     send_message(token, chat_id, "Format: <code>/setshareamt 1.00</code>", parse_mode="HTML")
                 else:
-                    try:
-                        amt = float(parts[1])
-                        if amt <= 0:
-                            raise ValueError("amt<=0")
+                    amt = _parse_amt(parts[1])
+                    if amt is None:
+                        send_message(token, chat_id, "❌ Amount tak sah. Contoh: <code>/setshareamt 1.00</code>", parse_mode="HTML")
+                    else:
                         with engine.begin() as conn:
-                            conn.execute(text("UPDATE bots SET affiliate_amount=:a WHERE id=:i"), {"a": amt, "i": bot_id})
+                            conn.execute(SQL_UPD_SHARE, {"a": amt, "i": bot_id})
+                        invalidate_bot_cache(bot_id)
                         send_message(token, chat_id, f"✅ Share commission set: <b>RM{amt:.2f}</b> per 1 click.", parse_mode="HTML")
-                    except Exception:
-                        send_message(token, chat_id, "❌ Amount tak sah. Contoh: <code>/setshareamt 1.00</code>", parse_mode="HTML")
 
             elif text_msg.startswith("/setminwithdraw"):
                 # /setminwithdraw 30.00  (min balance to request withdrawal)
-                parts = (text_msg or "").split()
                 if len(parts) < 2:
                     send_message(token, chat_id, "Format: <code>/setminwithdraw 30.00</code>", parse_mode="HTML")
                 else:
-                    try:
-                        amt = float(parts[1])
-                        if amt <= 0:
-                            raise ValueError("amt<=0")
+                    amt = _parse_amt(parts[1])
+                    if amt is None:
+                        send_message(token, chat_id, "❌ Amount tak sah. Contoh: <code>/setminwithdraw 30.00</code>", parse_mode="HTML")
+                    else:
                         with engine.begin() as conn:
-                            conn.execute(text("UPDATE bots SET min_withdraw_amount=:a WHERE id=:i"), {"a": amt, "i": bot_id})
+                            conn.execute(SQL_UPD_MINWD, {"a": amt, "i": bot_id})
+                        invalidate_bot_cache(bot_id)
                         send_message(token, chat_id, f"✅ Minimum withdraw set: <b>RM{amt:.2f}</b>", parse_mode="HTML")
-                    except Exception:
-                        send_message(token, chat_id, "❌ Amount tak sah. Contoh: <code>/setminwithdraw 30.00</code>", parse_mode="HTML")
 
             elif text_msg.startswith("/getrates"):
                 b2 = get_bot_by_id(bot_id) or bot_row
@@ -3209,40 +4088,38 @@ def telegram_webhook():
                     parse_mode="HTML",
                 )
             elif text_msg.startswith("/setlockbot"):
-                val = "on" in text_msg.lower()
+                val = "on" in arg_line.lower()
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET lock_bot=:v WHERE id=:i"), {"v": val, "i": bot_id})
+                    conn.execute(SQL_UPD_LOCK, {"v": val, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, f"🔒 PhoneLock: {val}", parse_mode="HTML")
 
             elif text_msg.startswith("/setadmingroup"):
                 with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET admin_group_id=:g WHERE id=:i"), {"g": chat_id, "i": bot_id})
+                    conn.execute(SQL_UPD_ADMIN_GROUP, {"g": chat_id, "i": bot_id})
+                invalidate_bot_cache(bot_id)
                 send_message(token, chat_id, "✅ Group Admin Disimpan.", parse_mode="HTML")
 
             elif text_msg.startswith(("/setstart", "/setloading")):
                 rep = msg.get("reply_to_message")
                 if rep:
                     mt, mid, txt = save_content_from_reply(rep)
-                    extra = "\n".join(text_msg.split("\n")[1:]).strip()
                     final_txt = (txt + ("\n" + extra if extra else "")).strip()
 
-                    col_txt = "start_text" if text_msg.startswith("/setstart") else "loading_text"
-                    col_type = "start_media_type" if text_msg.startswith("/setstart") else "loading_media_type"
-                    col_file = "start_media_file_id" if text_msg.startswith("/setstart") else "loading_media_file_id"
+                    is_start = text_msg.startswith("/setstart")
+                    col_txt = "start_text" if is_start else "loading_text"
+                    stmt = _SET_START_STMT if is_start else _SET_LOADING_STMT
 
                     with engine.begin() as conn:
-                        conn.execute(
-                            text(f"UPDATE bots SET {col_txt}=:t, {col_type}=:mt, {col_file}=:mf WHERE id=:i"),
-                            {"t": final_txt, "mt": mt, "mf": mid, "i": bot_id},
-                        )
+                        conn.execute(stmt, {"t": final_txt, "mt": mt, "mf": mid, "i": bot_id})
+                    invalidate_bot_cache(bot_id)
                     send_message(token, chat_id, f"✅ {col_txt} Updated.", parse_mode="HTML")
 
             elif text_msg.startswith("/addscanner"):
-                if (not is_owner(uid, bot_row)) and (not is_admin(uid, bot_id)):
+                if not require_admin(bot_row, uid):
                     tg_send_message(token, chat_id, "❌ Command ini untuk OWNER/ADMIN sahaja.", parse_mode="HTML")
                     return jsonify({"ok": True})
-                parts = text_msg.split(maxsplit=1)
-                provider = norm_provider(parts[1] if len(parts) > 1 else "")
+                provider = norm_provider(arg_all)
                 if not provider:
                     tg_send_message(token, chat_id, "❌ Format: /addscanner <provider>\nContoh: /addscanner jili", parse_mode="HTML")
                     return jsonify({"ok": True})
@@ -3273,17 +4150,17 @@ def telegram_webhook():
 
                 with engine.begin() as conn:
                     upsert_scanner_media(conn, bot_id, provider, media_type, file_id)
+                invalidate_scanner_keys(bot_id)
 
                 tg_send_message(token, chat_id, f"✅ Scanner media disimpan untuk <b>{html.escape(provider)}</b>.\n\nSeterusnya: /addgames {html.escape(provider)} (reply file txt).", parse_mode="HTML")
                 return jsonify({"ok": True})
 
             elif text_msg.startswith("/addgames") or text_msg.startswith("/updategames"):
-                if (not is_owner(uid, bot_row)) and (not is_admin(uid, bot_id)):
+                if not require_admin(bot_row, uid):
                     tg_send_message(token, chat_id, "❌ Command ini untuk OWNER/ADMIN sahaja.", parse_mode="HTML")
                     return jsonify({"ok": True})
                 is_update = text_msg.startswith("/updategames")
-                parts = text_msg.split(maxsplit=1)
-                provider = norm_provider(parts[1] if len(parts) > 1 else "")
+                provider = norm_provider(arg_line)
                 if not provider:
                     tg_send_message(token, chat_id, "❌ Format: /addgames <provider> (reply file txt)\nContoh: /addgames jili", parse_mode="HTML")
                     return jsonify({"ok": True})
@@ -3296,12 +4173,12 @@ def telegram_webhook():
                         file_id = rmsg["document"]["file_id"]
                         try:
                             # download content using getFile
-                            r = requests.get(f"https://api.telegram.org/bot{token}/getFile", params={"file_id": file_id}, timeout=20)
+                            r = SESSION.get(f"https://api.telegram.org/bot{token}/getFile", params={"file_id": file_id}, timeout=20)
                             j = r.json()
                             file_path = j.get("result", {}).get("file_path")
                             if not file_path:
                                 raise RuntimeError("file_path missing")
-                            fr = requests.get(f"https://api.telegram.org/file/bot{token}/{file_path}", timeout=30)
+                            fr = SESSION.get(f"https://api.telegram.org/file/bot{token}/{file_path}", timeout=30)
                             fr.raise_for_status()
                             raw = fr.text
                         except Exception as e:
@@ -3312,7 +4189,7 @@ def telegram_webhook():
                         raw = rmsg.get("text") or ""
                 else:
                     # allow /addgames provider <paste list>
-                    raw = parts[1] if len(parts) > 1 else ""
+                    raw = extra
 
                 games = parse_games_text(raw)
                 if not games:
@@ -3326,15 +4203,10 @@ def telegram_webhook():
                         # add without wiping existing
                         # we'll insert one by one with ON CONFLICT DO NOTHING
                         conn.execute(
-                            text(
-                                """
-                                INSERT INTO scanner_games (bot_id, provider, game)
-                                VALUES (:bot_id, :provider, :game)
-                                ON CONFLICT DO NOTHING
-                                """
-                            ),
+                            SQL_INS_SCANNER_GAME,
                             [{"bot_id": bot_id, "provider": provider, "game": g} for g in games],
                         )
+                invalidate_scanner_keys(bot_id)
 
                 verb = "dikemaskini" if is_update else "ditambah"
                 tg_send_message(token, chat_id, f"✅ List games <b>{html.escape(provider)}</b> {verb}: <b>{len(games)}</b> item.\n\nNota: Duplicate auto buang. Kalau kurang 20, bot akan paparkan semua.", parse_mode="HTML")
@@ -3345,12 +4217,11 @@ def telegram_webhook():
             
             elif text_msg.startswith("/clearscan"):
                 # OWNER / ADMIN sahaja - padam list game provider dalam DB
-                if (not is_owner(uid, bot_row)) and (not is_admin(uid, bot_id)):
+                if not require_admin(bot_row, uid):
                     tg_send_message(token, chat_id, "❌ Command ini untuk OWNER/ADMIN sahaja.", parse_mode="HTML")
                     return jsonify({"ok": True})
 
-                parts = text_msg.split(maxsplit=1)
-                arg = (parts[1].strip() if len(parts) > 1 else "")
+                arg = arg_line
                 if not arg:
                     tg_send_message(
                         token,
@@ -3363,32 +4234,25 @@ def telegram_webhook():
                 arg_norm = norm_provider(arg)
                 with engine.begin() as conn:
                     if arg_norm == "all":
-                        res = conn.execute(text("DELETE FROM scanner_games WHERE bot_id=:b"), {"b": bot_id})
+                        res = conn.execute(SQL_DEL_SCANNER_GAMES_ALL, {"b": bot_id})
                         deleted = int(getattr(res, "rowcount", 0) or 0)
                         tg_send_message(token, chat_id, f"✅ Clear scan: semua provider dibuang. (<b>{deleted}</b> item)", parse_mode="HTML")
                     else:
                         res = conn.execute(
-                            text("DELETE FROM scanner_games WHERE bot_id=:b AND provider=:p"),
+                            SQL_DEL_SCANNER_GAMES_PROVIDER,
                             {"b": bot_id, "p": arg_norm},
                         )
                         deleted = int(getattr(res, "rowcount", 0) or 0)
                         tg_send_message(token, chat_id, f"✅ Clear scan: provider <b>{html.escape(arg_norm)}</b> dibuang. (<b>{deleted}</b> item)", parse_mode="HTML")
+                invalidate_scanner_keys(bot_id)
                 return jsonify({"ok": True})
 
             elif text_msg.startswith("/setcallback"):
                 rep = msg.get("reply_to_message")
-                parts = text_msg.split()
                 if rep and len(parts) >= 2:
                     key = parts[1].strip()
-                    delay = 0
-                    if "delay=" in text_msg:
-                        try:
-                            delay = int(re.search(r"delay=(\d+)", text_msg).group(1))
-                        except Exception:
-                            delay = 0
 
                     mt, mid, txt = save_content_from_reply(rep)
-                    extra = "\n".join(text_msg.split("\n")[1:]).strip()
                     final_txt = (txt + ("\n" + extra if extra else "")).strip()
 
                     actions_upsert(bot_id, key, mt or "text", final_txt, mid, delay)
@@ -3397,7 +4261,6 @@ def telegram_webhook():
             # NEW: /setcommand
             elif text_msg.startswith("/setcommand"):
                 rep = msg.get("reply_to_message")
-                parts = text_msg.split()
                 if rep and len(parts) >= 2:
                     raw = parts[1].strip().lstrip("/")
                     cmd = re.sub(r"[^a-zA-Z0-9_]", "", raw).lower()
@@ -3405,15 +4268,7 @@ def telegram_webhook():
                         send_message(token, chat_id, "❌ Command name invalid. Contoh: /setcommand hello", parse_mode="HTML")
                         return "OK", 200
 
-                    delay = 0
-                    if "delay=" in text_msg:
-                        try:
-                            delay = int(re.search(r"delay=(\d+)", text_msg).group(1))
-                        except Exception:
-                            delay = 0
-
                     mt, mid, txt = save_content_from_reply(rep)
-                    extra = "\n".join(text_msg.split("\n")[1:]).strip()
                     final_txt = (txt + ("\n" + extra if extra else "")).strip()
 
                     key = f"cmd:{cmd}"
@@ -3423,7 +4278,6 @@ def telegram_webhook():
                     send_message(token, chat_id, "Cara: reply content + /setcommand hello", parse_mode="HTML")
 
             elif text_msg.startswith("/delcallback"):
-                parts = text_msg.split()
                 key = parts[1].strip() if len(parts) > 1 else ""
                 if key:
                     ok = delete_callback(bot_id, key)
@@ -3438,17 +4292,15 @@ def telegram_webhook():
                 rep_txt = rep.get("text") or rep.get("caption") or ""
 
                 # Premium manual approval by UID
-                uid_match = re.search(r"UID:\s*<code>(\d+)</code>", rep_txt)
+                uid_match = _REPLY_UID_RE.search(rep_txt)
+                if uid_match and len(_REPLY_UID_RE.findall(rep_txt)) > 1:
+                    send_message(token, chat_id, "⚠️ Mesej ni ada banyak UID. Guna button ikut UID.", parse_mode="HTML")
+                    return "OK", 200
                 if uid_match and bot_row.get("manual_approval"):
                     target_uid = int(uid_match.group(1))
                     is_app = text_msg.startswith("/approve")
                     with engine.begin() as conn:
-                        if is_app:
-                            conn.execute(text("UPDATE users SET is_premium=TRUE, premium_until=NULL WHERE bot_id=:b AND user_id=:u"),
-                                         {"b": bot_id, "u": target_uid})
-                        else:
-                            conn.execute(text("UPDATE users SET is_premium=FALSE, premium_until=NULL WHERE bot_id=:b AND user_id=:u"),
-                                         {"b": bot_id, "u": target_uid})
+                        conn.execute(SQL_UPD_PREMIUM, {"v": is_app, "b": bot_id, "u": target_uid})
 
                     if is_app:
                         msg_user = bot_row.get("verified_message") or (
@@ -3468,124 +4320,102 @@ def telegram_webhook():
                     return "OK", 200
 
                 # Withdraw approval by ID
-                rid_match = re.search(r"ID:\s*<code>([0-9a-fA-F-]+)</code>", rep_txt)
+                rid_match = _REPLY_WID_RE.search(rep_txt)
                 if rid_match:
                     rid = rid_match.group(1)
                     is_app = text_msg.startswith("/approve")
 
-                    with engine.begin() as conn:
-                        wd = conn.execute(
-                            text("SELECT * FROM withdrawals WHERE id=:i"),
-                            {"i": rid},
-                        ).mappings().first()
-
-                        if not wd:
-                            send_message(token, chat_id, "⚠️ Withdrawal ID tak jumpa.", parse_mode="HTML")
+                    amt = None
+                    if is_app:
+                        # /approve 50  (amount wajib)
+                        if len(parts) < 2:
+                            send_message(token, chat_id, "Format: <code>/approve 50</code>", parse_mode="HTML")
                             return "OK", 200
-
-                        if wd["status"] != "PENDING":
-                            send_message(token, chat_id, "⚠️ Withdrawal dah diproses sebelum ni.", parse_mode="HTML")
+                        amt = _parse_amt(parts[1])
+                        if amt is None:
+                            send_message(token, chat_id, "❌ Amount tak sah.", parse_mode="HTML")
                             return "OK", 200
 
-                        if is_app:
-                            # /approve 50  (amount wajib)
-                            parts = (text_msg or "").split()
-                            if len(parts) < 2:
-                                send_message(token, chat_id, "Format: <code>/approve 50</code>", parse_mode="HTML")
-                                return "OK", 200
-                            try:
-                                amt = float(parts[1])
-                            except Exception:
-                                send_message(token, chat_id, "Format: <code>/approve 50</code>", parse_mode="HTML")
-                                return "OK", 200
-
-                            if amt <= 0:
-                                send_message(token, chat_id, "❌ Amount tak sah.", parse_mode="HTML")
-                                return "OK", 200
-
-                            # Lock user row, check balance
-                            u = conn.execute(
-                                text("SELECT balance FROM users WHERE bot_id=:b AND user_id=:u FOR UPDATE"),
-                                {"b": bot_id, "u": wd["user_id"]},
+                    # Semua DB work dalam satu transaction; mesej Telegram hanya dihantar
+                    # lepas commit supaya connection pool tak tertahan semasa HTTPS call.
+                    outbound = []  # [(chat_id, text), ...]
+                    try:
+                        with engine.begin() as conn:
+                            wd = conn.execute(
+                                SQL_SEL_WITHDRAWAL,
+                                {"i": rid},
                             ).mappings().first()
-                            bal_before = float((u or {}).get("balance") or 0)
-
-                            if bal_before < amt:
-                                send_message(
-                                    token,
-                                    chat_id,
-                                    f"❌ Balance tak cukup untuk approve.\nBal user: RM{bal_before:.2f}\nApprove: RM{amt:.2f}",
-                                    parse_mode="HTML",
-                                )
-                                return "OK", 200
-
-                            # Deduct balance + mark approved
-                            conn.execute(
-                                text("UPDATE users SET balance=balance-:a WHERE bot_id=:b AND user_id=:u"),
-                                {"a": amt, "b": bot_id, "u": wd["user_id"]},
-                            )
-                            conn.execute(
-                                text("""
-                                    UPDATE withdrawals
-                                    SET status='APPROVED',
-                                        approved_amount=:a,
-                                        processed_at=NOW(),
-                                        processed_by=:by
-                                    WHERE id=:i
-                                """),
-                                {"a": amt, "i": rid, "by": uid},
-                            )
 
-                            bal_after = bal_before - amt
-                            msg_user = (
-                                "✅ <b>WITHDRAW BERJAYA</b>\n"
-                                f"Jumlah: <b>RM{amt:.2f}</b>\n"
-                                f"Baki sekarang: <b>RM{bal_after:.2f}</b>\n\n"
-                                "Bossku, duit sedang diproses 😘"
-                            )
-                            send_message(token, int(wd["user_id"]), msg_user, parse_mode="HTML")
-                            send_message(token, chat_id, f"✅ Withdraw Approved. (Baki user: RM{bal_after:.2f})", parse_mode="HTML")
-                            return "OK", 200
+                            if not wd:
+                                outbound.append((chat_id, "⚠️ Withdrawal ID tak jumpa."))
+
+                            elif wd["status"] != "PENDING":
+                                outbound.append((chat_id, "⚠️ Withdrawal dah diproses sebelum ni."))
+
+                            elif is_app:
+                                # Conditional debit (balance>=amt) + mark approved, tanpa row lock
+                                r = conn.execute(
+                                    SQL_APPROVE_WD_DEBIT,
+                                    {"a": amt, "b": bot_id, "u": wd["user_id"], "i": rid, "by": uid},
+                                ).mappings().first()
+
+                                if r["balance_after"] is None:
+                                    bal_now = conn.execute(
+                                        SQL_SEL_BALANCE,
+                                        {"b": bot_id, "u": wd["user_id"]},
+                                    ).scalar()
+                                    outbound.append((
+                                        chat_id,
+                                        f"❌ Balance tak cukup untuk approve.\nBal user: RM{float(bal_now or 0):.2f}\nApprove: RM{amt:.2f}",
+                                    ))
+                                elif not r["approved"]:
+                                    # debit berlaku tapi withdrawal dah bukan PENDING -> rollback
+                                    raise WithdrawalConflict(rid)
+                                else:
+                                    bal_after = float(r["balance_after"])
+                                    msg_user = (
+                                        "✅ <b>WITHDRAW BERJAYA</b>\n"
+                                        f"Jumlah: <b>RM{amt:.2f}</b>\n"
+                                        f"Baki sekarang: <b>RM{bal_after:.2f}</b>\n\n"
+                                        "Bossku, duit sedang diproses 😘"
+                                    )
+                                    outbound.append((int(wd["user_id"]), msg_user))
+                                    outbound.append((chat_id, f"✅ Withdraw Approved. (Baki user: RM{bal_after:.2f})"))
 
-                        # Reject
-                        conn.execute(
-                            text("""
-                                UPDATE withdrawals
-                                SET status='REJECTED',
-                                    processed_at=NOW(),
-                                    processed_by=:by
-                                WHERE id=:i
-                            """),
-                            {"i": rid, "by": uid},
-                        )
-                        send_message(
-                            token,
-                            int(wd["user_id"]),
-                            "❌ <b>WITHDRAW DITOLAK</b>\nRequest ditolak. Sila semak detail & try lagi.",
-                            parse_mode="HTML",
-                        )
-                        send_message(token, chat_id, "❌ Withdraw Rejected.", parse_mode="HTML")
+                            else:
+                                # Reject (conditional: hanya kalau masih PENDING)
+                                if not conn.execute(SQL_UPD_WD_REJECTED, {"i": rid, "by": uid}).first():
+                                    raise WithdrawalConflict(rid)
+                                outbound.append((
+                                    int(wd["user_id"]),
+                                    "❌ <b>WITHDRAW DITOLAK</b>\nRequest ditolak. Sila semak detail & try lagi.",
+                                ))
+                                outbound.append((chat_id, "❌ Withdraw Rejected."))
+                    except WithdrawalConflict:
+                        outbound = [(chat_id, "⚠️ Withdrawal dah diproses sebelum ni.")]
+
+                    for out_chat, out_txt in outbound:
+                        send_message(token, out_chat, out_txt, parse_mode="HTML")
                     return "OK", 200
 # Dynamic command triggers (after builtins)
         if text_msg.startswith("/"):
             cmd = parse_command_name(text_msg)
             if cmd:
-                act = actions_get(bot_id, f"cmd:{cmd}")
+                act, urow, scan_raw = actions_get_with_user(bot_id, f"cmd:{cmd}", uid)
                 if act:
                     if int(act.get("delay_seconds") or 0) > 0:
                         time.sleep(int(act["delay_seconds"]))
 
-                    urow = get_user_row(bot_id, uid) or {"user_id": uid, "first_name": from_user.get("first_name"), "username": from_user.get("username")}
+                    urow = urow or {"user_id": uid, "first_name": from_user.get("first_name"), "username": from_user.get("username")}
                     if not ensure_access(bot_row, chat_id, uid, urow):
                         return "OK", 200
 
                     txt = render_placeholders(act.get("text") or "", bot_row.get("bot_username") or "", urow)
 
-                    # scan placeholders ({count}/{limit}/{remaining}/{reset})
-
-                    with engine.connect() as _c:
-
-                        txt = apply_scan_placeholders(_c, txt, bot_row, bot_id, int((urow or {}).get("user_id") or uid))
+                    # scan placeholders ({count}/{limit}/{remaining}/{reset}) - counters already fetched above
+                    scan_override, scan_used = scan_raw
+                    scan_stats = scan_daily_stats_from_values(_resolve_scan_limit(bot_row, scan_override), scan_used)
+                    txt = apply_scan_placeholders(None, txt, bot_row, bot_id, uid, stats=scan_stats)
                     share_q = make_share_query(bot_row.get("bot_username") or "", urow)
                     txt, markup = parse_buttons(txt, share_inline_query=share_q)
 
@@ -3602,6 +4432,7 @@ def telegram_webhook():
         msg = cq.get("message") or {}
         chat_id = msg.get("chat", {}).get("id")
         message_id = msg.get("message_id")
+        cq_message_text = msg.get("text") or ""
         data = cq.get("data", "")
         from_user = cq.get("from") or {}
         uid = from_user.get("id")
@@ -3609,662 +4440,658 @@ def telegram_webhook():
         if not chat_id or not uid:
             return "OK", 200
 
-        user_row, _ = upsert_user(bot_id, from_user, None)
+        # Flood guard: non-2xx -> Telegram hantar semula update ni kemudian
+        if not _CB_SEM.acquire(timeout=1.0):
+            logger.warning(f"callback busy: bot={bot_id} parallel>={CB_MAX_PARALLEL}")
+            return "BUSY", 429
+        try:
+            if TG_SEND_RATE > 0 and not tg_send_bucket(token).try_acquire():
+                answer_callback(token, cq["id"], "⏳ Sibuk, cuba lagi sebentar.")
+                return "OK", 200
 
-        # Gate recheck for joinlock
-        if data == "gate:recheck":
-            answer_callback(token, cq["id"], "Checking…", show_alert=False)
-            bot_row2 = get_bot_by_id(bot_id) or bot_row
-            if ensure_access(bot_row2, chat_id, uid, user_row):
-                send_message(token, chat_id, "✅ Dah lepas gate Bossku. Teruskan 😘", parse_mode="HTML")
+            user_row, _ = upsert_user(bot_id, from_user, None)
+
+            # O(1) dispatch on the callback_data prefix ("wd:ap:<id>" -> "wd")
+            head, sep, _ = data.partition(":")
+            handler = _CB_DISPATCH.get(head) if sep else _CB_DISPATCH.get(data)
+            if handler:
+                return handler(bot_row, cq, data, chat_id, message_id, from_user, uid, user_row, cq_message_text)
+
+            answer_callback_fast(token, cq["id"])
             return "OK", 200
+        finally:
+            _CB_SEM.release()
 
-        # Admin approve buttons (manual approval)
-        elif data.startswith("adm:"):
-            if not require_admin(bot_row, uid):
-                answer_callback(token, cq["id"], "No access", show_alert=True)
-                return "OK", 200
+    return "OK", 200
 
-            parts = data.split(":")
-            action = parts[1] if len(parts) > 1 else ""
-
-            # Settings categories navigation
-            if action == "cat":
-                cat = parts[2] if len(parts) > 2 else "home"
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_ctx={"message_id": message_id}, cat=cat)
-                answer_callback(token, cq["id"])
-            # (scan limit gate removed from adm:* handlers; handled in cb:* scanner path)
-
-            if action == "home":
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_ctx={"message_id": message_id}, cat="home")
-                answer_callback(token, cq["id"])
-                return "OK", 200
 
-            if action == "full":
-                p = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 1
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=p, edit_ctx={"message_id": message_id})
-                answer_callback(token, cq["id"])
-                return "OK", 200
+# ---------------------------
+# CALLBACK HANDLERS (callback_query)
+# ---------------------------
+def _cb_gate(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # Gate recheck for joinlock
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
 
-            target_uid = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
-            if not target_uid:
-                answer_callback(token, cq["id"], "Invalid target", show_alert=True)
-                return "OK", 200
+    answer_callback(token, cq["id"], "Checking…", show_alert=False)
+    bot_row2 = get_bot_by_id(bot_id) or bot_row
+    if ensure_access(bot_row2, chat_id, uid, user_row):
+        send_message(token, chat_id, "✅ Dah lepas gate Bossku. Teruskan 😘", parse_mode="HTML")
+    return "OK", 200
 
-            # Protect: admin/owner tak patut jadi target premium manual approve
-            if require_admin(bot_row, int(target_uid)):
-                answer_callback(token, cq["id"], "Target ialah admin/owner (skip).", show_alert=True)
-                return "OK", 200
 
-            if action == "ap":
-                with engine.begin() as conn:
-                    conn.execute(
-                        text("UPDATE users SET is_premium=TRUE, premium_until=NULL WHERE bot_id=:b AND user_id=:u"),
-                        {"b": bot_id, "u": target_uid},
-                    )
+def _cb_adm(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # Admin approve buttons (manual approval) + settings category navigation
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
 
-                msg_user = bot_row.get("verified_message") or (
-                    "🎉 <b>PREMIUM AKTIF, BOSSKU!</b>\n"
-                    "Akses kau dah unlock ✅\n"
-                    "Sekarang boleh guna semua menu premium 🔥"
-                )
-                send_message(token, target_uid, msg_user, parse_mode="HTML")
+    if not require_admin(bot_row, uid):
+        answer_callback(token, cq["id"], "No access", show_alert=True)
+        return "OK", 200
 
-                # Update mesej admin (macam flow approve withdrawal) + lock button                answer_callback(token, cq["id"], "✅ Approved", show_alert=False)
+    # "adm:<action>:<arg>" - partition, tiada list allocation
+    action, _, arg = data.partition(":")[2].partition(":")
 
-                # Update mesej admin (macam flow approve withdrawal) + lock button
-                try:
-                    _m = cq.get("message") or {}
-                    _chat_id = (_m.get("chat") or {}).get("id")
-                    _msg_id = _m.get("message_id")
-                    if _chat_id and _msg_id:
-                        _from = cq.get("from") or {}
-                        _admin_id = _from.get("id")
-                        _admin_name = _from.get("first_name") or "Admin"
-                        _admin_user = _from.get("username")
-                        _who = f"@{_admin_user}" if _admin_user else f"<a href='tg://user?id={_admin_id}'>{html.escape(_admin_name)}</a>"
-                        _stamp = now_local_str("%Y-%m-%d %H:%M:%S")
-                        _cur = _m.get("text") or ""
-                        if ("<b>APPROVED</b>" not in _cur) and ("<b>REJECTED</b>" not in _cur):
-                            _cur = _cur + f"\n\n✅ <b>APPROVED</b>\nBy: {_who}\nAt: {_stamp}"
-                        edit_message(token, _chat_id, _msg_id, _cur, reply_markup={"inline_keyboard": []}, parse_mode="HTML")
-                except Exception:
-                    logger.exception("Failed to update admin premium message (approve)")
+    # Settings categories navigation
+    if action == "cat":
+        answer_callback_fast(token, cq["id"])
+        cat = arg or "home"
+        bot_row2 = get_bot_by_id(bot_id) or bot_row
+        send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_message_id=message_id, cat=cat)
+        return "OK", 200
+    # (scan limit gate removed from adm:* handlers; handled in cb:* scanner path)
 
-                answer_callback(token, cq["id"], "Approved ✅", show_alert=False)
+    if action == "home":
+        answer_callback_fast(token, cq["id"])
+        bot_row2 = get_bot_by_id(bot_id) or bot_row
+        send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_message_id=message_id, cat="home")
+        return "OK", 200
 
-            elif action == "rj":
-                with engine.begin() as conn:
-                    conn.execute(
-                        text("UPDATE users SET is_premium=FALSE, premium_until=NULL WHERE bot_id=:b AND user_id=:u"),
-                        {"b": bot_id, "u": target_uid},
-                    )
+    if action == "full":
+        answer_callback_fast(token, cq["id"])
+        p = int(arg) if arg.isdigit() else 1
+        bot_row2 = get_bot_by_id(bot_id) or bot_row
+        send_or_edit_settings_panel(bot_row2, chat_id, uid, page=p, edit_message_id=message_id)
+        return "OK", 200
 
-                msg_user = bot_row.get("rejected_message") or (
-                    "❌ <b>PREMIUM DITOLAK</b>\n"
-                    "Bossku, admin tolak request. Kalau silap, boleh try semula."
-                )
-                send_message(token, target_uid, msg_user, parse_mode="HTML")
+    target_uid = int(arg) if arg.isdigit() else 0
+    if not target_uid:
+        answer_callback(token, cq["id"], "Invalid target", show_alert=True)
+        return "OK", 200
 
-                # Update mesej admin (macam flow reject withdrawal) + lock button                answer_callback(token, cq["id"], "❌ Rejected", show_alert=False)
+    # Protect: admin/owner tak patut jadi target premium manual approve
+    if require_admin(bot_row, int(target_uid)):
+        answer_callback(token, cq["id"], "Target ialah admin/owner (skip).", show_alert=True)
+        return "OK", 200
 
-                # Update mesej admin (macam flow reject withdrawal) + lock button
-                try:
-                    _m = cq.get("message") or {}
-                    _chat_id = (_m.get("chat") or {}).get("id")
-                    _msg_id = _m.get("message_id")
-                    if _chat_id and _msg_id:
-                        _from = cq.get("from") or {}
-                        _admin_id = _from.get("id")
-                        _admin_name = _from.get("first_name") or "Admin"
-                        _admin_user = _from.get("username")
-                        _who = f"@{_admin_user}" if _admin_user else f"<a href='tg://user?id={_admin_id}'>{html.escape(_admin_name)}</a>"
-                        _stamp = now_local_str("%Y-%m-%d %H:%M:%S")
-                        _cur = _m.get("text") or ""
-                        if ("<b>APPROVED</b>" not in _cur) and ("<b>REJECTED</b>" not in _cur):
-                            _cur = _cur + f"\n\n❌ <b>REJECTED</b>\nBy: {_who}\nAt: {_stamp}"
-                        edit_message(token, _chat_id, _msg_id, _cur, reply_markup={"inline_keyboard": []}, parse_mode="HTML")
-                except Exception:
-                    logger.exception("Failed to update admin premium message (reject)")
+    if action in ("ap", "rj") and not _admin_msg_claim(chat_id, message_id, target_uid):
+        answer_callback(token, cq["id"], "Already processed", show_alert=True)
+        return "OK", 200
 
-                answer_callback(token, cq["id"], "Rejected ❌", show_alert=False)
+    if action == "ap":
+        with engine.begin() as conn:
+            conn.execute(SQL_UPD_PREMIUM, {"v": True, "b": bot_id, "u": target_uid})
+        # stop spinner dulu, baru kerja Telegram yang lambat
+        answer_callback(token, cq["id"], "Approved ✅", show_alert=False)
+
+        msg_user = bot_row.get("verified_message") or (
+            "🎉 <b>PREMIUM AKTIF, BOSSKU!</b>\n"
+            "Akses kau dah unlock ✅\n"
+            "Sekarang boleh guna semua menu premium 🔥"
+        )
+        send_message(token, target_uid, msg_user, parse_mode="HTML")
 
-            return "OK", 200
+        # Update mesej admin (macam flow approve withdrawal) + lock button
+        _admin_msg_stamp(token, chat_id, message_id, from_user, cq, cq_message_text, target_uid, "✅ <b>APPROVED</b>")
 
+    elif action == "rj":
+        with engine.begin() as conn:
+            conn.execute(SQL_UPD_PREMIUM, {"v": False, "b": bot_id, "u": target_uid})
+        answer_callback(token, cq["id"], "Rejected ❌", show_alert=False)
 
-        # Withdrawal approve/reject buttons
-        elif data.startswith("wd:"):
-            if not require_admin(bot_row, uid):
-                answer_callback(token, cq["id"], "No access", show_alert=True)
-                return "OK", 200
+        msg_user = bot_row.get("rejected_message") or (
+            "❌ <b>PREMIUM DITOLAK</b>\n"
+            "Bossku, admin tolak request. Kalau silap, boleh try semula."
+        )
+        send_message(token, target_uid, msg_user, parse_mode="HTML")
 
-            # data: wd:ap:<uuid> OR wd:rj:<uuid>
-            parts = data.split(":", 2)
-            action = parts[1] if len(parts) > 1 else ""
-            wid = parts[2] if len(parts) > 2 else ""
+        # Update mesej admin (macam flow reject withdrawal) + lock button
+        _admin_msg_stamp(token, chat_id, message_id, from_user, cq, cq_message_text, target_uid, "❌ <b>REJECTED</b>")
 
-            if not re.match(r"^[0-9a-fA-F-]{20,}$", wid):
-                answer_callback(token, cq["id"], "Invalid ID", show_alert=True)
-                return "OK", 200
+    else:
+        answer_callback_fast(token, cq["id"])
+
+    return "OK", 200
 
+
+def _cb_wd(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # Withdrawal approve/reject buttons
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
+
+    if not require_admin(bot_row, uid):
+        answer_callback(token, cq["id"], "No access", show_alert=True)
+        return "OK", 200
+
+    # data: wd:ap:<uuid> OR wd:rj:<uuid> - satu regex scan untuk action + id
+    m = _WD_CB_RE.match(data)
+    if not m:
+        # bad input sahaja sampai sini; asingkan mesej error macam dulu
+        bad_wid = data.partition(":")[2].partition(":")[2]
+        err = "Invalid ID" if not _WID_RE.match(bad_wid) else "Unknown action"
+        answer_callback(token, cq["id"], err, show_alert=True)
+        return "OK", 200
+    action, wid = m.group(1), m.group(2)
+
+    # Lock-free read; guard sebenar = conditional UPDATE (status='PENDING') di bawah
+    with engine.connect() as conn:
+        wd = conn.execute(SQL_SEL_WITHDRAWAL, {"i": wid}).mappings().first()
+
+    if not wd:
+        answer_callback(token, cq["id"], "WD not found", show_alert=True)
+        return "OK", 200
+
+    if wd["status"] != "PENDING":
+        answer_callback(token, cq["id"], f"Already {wd['status']}", show_alert=True)
+        return "OK", 200
+
+    wd_uid = int(wd["user_id"])
+    bot_latest = get_bot_by_id(bot_id) or bot_row
+
+    if action == "ap":
+        req_text = (wd.get("request_text") or "")
+        mamt = _AMT_IN_TEXT_RE.search(req_text)
+        if not mamt:
+            answer_callback(token, cq["id"], "Tak jumpa amount. Guna /approve <amount> (reply).", show_alert=True)
+            return "OK", 200
+        amt = float(mamt.group(1))
+        if amt <= 0:
+            answer_callback(token, cq["id"], "Amount tak sah.", show_alert=True)
+            return "OK", 200
+
+        # balance check + debit + mark approved = 1 statement (DB sahaja dalam transaction)
+        bal_now = None
+        try:
             with engine.begin() as conn:
-                wd = conn.execute(
-                    text("SELECT * FROM withdrawals WHERE id=:i FOR UPDATE"),
-                    {"i": wid},
+                r = conn.execute(
+                    SQL_APPROVE_WD_DEBIT,
+                    {"a": amt, "b": bot_id, "u": wd_uid, "i": wid, "by": uid},
                 ).mappings().first()
+                if r["balance_after"] is None:
+                    bal_now = float(conn.execute(SQL_SEL_BALANCE, {"b": bot_id, "u": wd_uid}).scalar() or 0)
+                elif not r["approved"]:
+                    raise WithdrawalConflict(wid)
+        except WithdrawalConflict:
+            answer_callback(token, cq["id"], "Already processed", show_alert=True)
+            return "OK", 200
 
-                if not wd:
-                    answer_callback(token, cq["id"], "WD not found", show_alert=True)
-                    return "OK", 200
+        if bal_now is not None:
+            answer_callback(token, cq["id"], f"Balance tak cukup (RM{bal_now:.2f}).", show_alert=True)
+            return "OK", 200
 
-                if wd["status"] != "PENDING":
-                    answer_callback(token, cq["id"], f"Already {wd['status']}", show_alert=True)
-                    return "OK", 200
+        bal_after = float(r["balance_after"])
+        bal_before = bal_after + amt
+        tpl = bot_latest.get("withdrawal_approve_message") or (
+            "✅ <b>WITHDRAW BERJAYA</b>\n"
+            "Jumlah: <b>{amount}</b>\n"
+            "Baki sekarang: <b>{balance_after}</b>\n\n"
+            "Bossku, duit sedang diproses 😘"
+        )
+        msg_user = render_withdrawal_template(tpl, amt, bal_before, bal_after)
+        mt = bot_latest.get("withdrawal_approve_media_type")
+        mf = bot_latest.get("withdrawal_approve_media_file_id")
+        status_html, toast = "✅ <b>APPROVED</b>", "Approved ✅"
 
-                u = conn.execute(
-                    text("SELECT balance FROM users WHERE bot_id=:b AND user_id=:u FOR UPDATE"),
-                    {"b": bot_id, "u": wd["user_id"]},
-                ).mappings().first()
-                bal_before = float((u or {}).get("balance") or 0)
+    else:
+        with engine.begin() as conn:
+            rej = conn.execute(SQL_UPD_WD_REJECTED, {"i": wid, "by": uid}).first()
+            bal_before = float(conn.execute(SQL_SEL_BALANCE, {"b": bot_id, "u": wd_uid}).scalar() or 0) if rej else 0.0
+        if not rej:
+            answer_callback(token, cq["id"], "Already processed", show_alert=True)
+            return "OK", 200
 
-                if action == "ap":
-                    req_text = (wd.get("request_text") or "")
-                    mamt = re.search(r"(\d+(?:\.\d+)?)", req_text)
-                    if not mamt:
-                        answer_callback(token, cq["id"], "Tak jumpa amount. Guna /approve <amount> (reply).", show_alert=True)
-                        return "OK", 200
-                    amt = float(mamt.group(1))
-                    if amt <= 0:
-                        answer_callback(token, cq["id"], "Amount tak sah.", show_alert=True)
-                        return "OK", 200
-                    if bal_before < amt:
-                        answer_callback(token, cq["id"], f"Balance tak cukup (RM{bal_before:.2f}).", show_alert=True)
-                        return "OK", 200
+        tpl = bot_latest.get("withdrawal_reject_message") or (
+            "❌ <b>WITHDRAW DITOLAK</b>\n"
+            "Request ditolak. Sila semak detail & cuba lagi."
+        )
+        msg_user = render_withdrawal_template(tpl, 0.0, bal_before, bal_before)
+        mt = bot_latest.get("withdrawal_reject_media_type")
+        mf = bot_latest.get("withdrawal_reject_media_file_id")
+        status_html, toast = "❌ <b>REJECTED</b>", "Rejected ❌"
+
+    # Telegram I/O hanya selepas commit; toast dulu supaya spinner admin berhenti segera
+    answer_callback(token, cq["id"], toast, show_alert=False)
+    if mt and mf:
+        send_media(token, wd_uid, mt, mf, caption=msg_user, parse_mode="HTML")
+    else:
+        send_message(token, wd_uid, msg_user, parse_mode="HTML")
 
-                    conn.execute(
-                        text("UPDATE users SET balance=balance-:a WHERE bot_id=:b AND user_id=:u"),
-                        {"a": amt, "b": bot_id, "u": wd["user_id"]},
-                    )
-                    conn.execute(
-                        text("""
-                            UPDATE withdrawals
-                            SET status='APPROVED',
-                                approved_amount=:a,
-                                processed_at=NOW(),
-                                processed_by=:by
-                            WHERE id=:i
-                        """),
-                        {"a": amt, "i": wid, "by": uid},
-                    )
+    # Update the admin/group message so you can SEE the result (and lock the buttons)
+    _stamp_and_lock_admin_message(token, chat_id, message_id, from_user, cq_message_text, status_html)
+    return "OK", 200
 
-                    bal_after = bal_before - amt
-                    bot_latest = get_bot_by_id(bot_id) or bot_row
-                    tpl = bot_latest.get("withdrawal_approve_message") or (
-                        "✅ <b>WITHDRAW BERJAYA</b>\n"
-                        "Jumlah: <b>{amount}</b>\n"
-                        "Baki sekarang: <b>{balance_after}</b>\n\n"
-                        "Bossku, duit sedang diproses 😘"
-                    )
-                    msg_user = render_withdrawal_template(tpl, amt, bal_before, bal_after)
 
-                    mt = bot_latest.get("withdrawal_approve_media_type")
-                    mf = bot_latest.get("withdrawal_approve_media_file_id")
-                    if mt and mf:
-                        send_media(token, int(wd["user_id"]), mt, mf, caption=msg_user, parse_mode="HTML")
-                    else:
-                        send_message(token, int(wd["user_id"]), msg_user, parse_mode="HTML")
+def _render_action(bot_row: dict, act: dict, bot_id: str, uid) -> Tuple[str, Optional[dict]]:
+    """Action text + keyboard untuk user ni (placeholders, scan counters, share query)."""
+    # user row + scan placeholders ({count}/{limit}/{remaining}/{reset}) on one connection
+    with engine.connect() as _c:
+        urow = get_user_row(bot_id, uid, conn=_c) or {"user_id": uid}
+        txt = render_placeholders(act.get("text") or "", bot_row.get("bot_username") or "", urow)
+        txt = apply_scan_placeholders(_c, txt, bot_row, bot_id, int((urow or {}).get("user_id") or uid))
+    share_q = make_share_query(bot_row.get("bot_username") or "", urow)
+    return parse_buttons(txt, share_inline_query=share_q)
 
-                    # Update the admin/group message so you can SEE it was approved (and lock the buttons)
-                    try:
-                        _m = cq.get("message") or {}
-                        _chat_id = (_m.get("chat") or {}).get("id")
-                        _msg_id = _m.get("message_id")
-                        if _chat_id and _msg_id:
-                            _from = cq.get("from") or {}
-                            _admin_id = _from.get("id")
-                            _admin_name = _from.get("first_name") or "Admin"
-                            _admin_user = _from.get("username")
-                            _who = f"@{_admin_user}" if _admin_user else f"<a href='tg://user?id={_admin_id}'>{html.escape(_admin_name)}</a>"
-                            _stamp = now_local_str("%Y-%m-%d %H:%M:%S")
-                            _cur = _m.get("text") or ""
-                            if ("<b>APPROVED</b>" not in _cur) and ("<b>REJECTED</b>" not in _cur):
-                                _cur = _cur + f"\n\n✅ <b>APPROVED</b>\nBy: {_who}\nAt: {_stamp}"
-                            # remove inline keyboard (avoid double approve/reject)
-                            edit_message(token, _chat_id, _msg_id, _cur, reply_markup={"inline_keyboard": []}, parse_mode="HTML")
-                    except Exception:
-                        logger.exception("Failed to update admin withdrawal message (approve)")
-                    answer_callback(token, cq["id"], "Approved ✅", show_alert=False)
-
-                elif action == "rj":
-                    conn.execute(
-                        text("""
-                            UPDATE withdrawals
-                            SET status='REJECTED',
-                                processed_at=NOW(),
-                                processed_by=:by
-                            WHERE id=:i
-                        """),
-                        {"i": wid, "by": uid},
-                    )
 
-                    bot_latest = get_bot_by_id(bot_id) or bot_row
-                    tpl = bot_latest.get("withdrawal_reject_message") or (
-                        "❌ <b>WITHDRAW DITOLAK</b>\n"
-                        "Request ditolak. Sila semak detail & cuba lagi."
-                    )
-                    msg_user = render_withdrawal_template(tpl, 0.0, bal_before, bal_before)
+def _emit_action(token: str, chat_id, message_id, act: dict, txt: str, markup) -> None:
+    """Edit message asal (media kalau action ada media); tiada message_id -> hantar baru."""
+    if not message_id:
+        send_message(token, chat_id, txt or " ", reply_markup=markup, parse_mode="HTML")
+        return
+    if act["type"] != "text" and act.get("media_file_id"):
+        # Prefer media edit when action includes media
+        try:
+            edit_media(token, chat_id, message_id, act["type"], act["media_file_id"], caption=txt, reply_markup=markup, parse_mode="HTML")
+            return
+        except Exception:
+            pass  # fallback edit text
+    edit_message(token, chat_id, message_id, txt or " ", reply_markup=markup, parse_mode="HTML")
 
-                    mt = bot_latest.get("withdrawal_reject_media_type")
-                    mf = bot_latest.get("withdrawal_reject_media_file_id")
-                    if mt and mf:
-                        send_media(token, int(wd["user_id"]), mt, mf, caption=msg_user, parse_mode="HTML")
-                    else:
-                        send_message(token, int(wd["user_id"]), msg_user, parse_mode="HTML")
 
-                    # Update the admin/group message so you can SEE it was rejected (and lock the buttons)
+def _cb_action(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # Callback actions stored in DB
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
+
+    # Callback actions stored in DB (premium mode: edit in-place)
+    raw = data.split(":", 1)[1].strip()
+    delay_override = None
+    if ";d=" in raw:
+        key_part, d_part = raw.split(";d=", 1)
+        raw = key_part.strip()
+        mdel = _CB_DELAY_RE.match((d_part or "").strip())
+        if mdel:
+            try:
+                delay_override = int(mdel.group(1))
+            except Exception:
+                delay_override = None
+    key = raw.strip()
+    # normalize scan_* keys -> provider (e.g., scan_jili -> jili)
+    if key.startswith("scan_"):
+        key = key.split("scan_", 1)[1]
+
+    # Spam tekan scanner dalam window cooldown -> toast terus dari memory, sebelum
+    # gate (tak buka transaction, tak tambah kuota harian)
+    remaining = scanner_cooldown_remaining(bot_id, int(uid), key)
+    if remaining > 0:
+        answer_callback(token, cq["id"], text_=f"⏳ Tunggu {remaining}s", show_alert=False)
+        return "OK", 200
+
+    # ===== DAILY SCAN LIMIT GATE (for scanner providers, even if action exists) =====
+    try:
+        # non-scanner key (cached) -> skip gate tanpa DB
+        if is_scanner_key(bot_id, key):
+            _msg = None
+            # fetch latest bot config (in case just updated)
+            _bot_latest = get_bot_by_id(bot_id) or bot_row
+            with engine.begin() as _conn_gate:
+                _is_scanner, _allowed, _used_after, _lim = scan_daily_gate(_conn_gate, _bot_latest, bot_id, int(uid), key)
+                if _is_scanner and not _allowed:
+                    _urow_gate = user_row or get_user_row(bot_id, uid) or {"user_id": uid, "username": from_user.get("username"), "first_name": from_user.get("first_name")}
+                    _tpl = (_bot_latest.get("scan_limit_message") or "").strip() or "🚫 Had scan harian anda telah habis.\nLimit: {limit}/hari\nCuba semula esok."
+                    _msg = render_placeholders(_tpl, _bot_latest.get("bot_username") or "", _urow_gate)
+                    _msg = apply_scan_placeholders(_conn_gate, _msg, _bot_latest, bot_id, int(uid))
+                    # extra placeholders
+                    _lim_int = int(_lim or 0)
+                    _used_int = int(_used_after or 0)
+                    _remaining = max(0, _lim_int - _used_int) if _lim_int > 0 else 0
+
+                    _msg = (_msg
+                            .replace("{limit}", str(_lim_int if _lim_int else _lim or ""))
+                            .replace("{used}", str(_used_int))
+                            .replace("{remaining}", str(_remaining)))
+
+            if _msg is not None:
+                _kb_lim = _KB_BACK_MENU_SCANNER
+
+                # always show alert + send new message (do NOT edit old media message)
+                try:
+                    answer_callback(token, cq["id"], (_msg[:180] if _msg else "Limit harian habis"), show_alert=True)
+                except Exception:
                     try:
-                        _m = cq.get("message") or {}
-                        _chat_id = (_m.get("chat") or {}).get("id")
-                        _msg_id = _m.get("message_id")
-                        if _chat_id and _msg_id:
-                            _from = cq.get("from") or {}
-                            _admin_id = _from.get("id")
-                            _admin_name = _from.get("first_name") or "Admin"
-                            _admin_user = _from.get("username")
-                            _who = f"@{_admin_user}" if _admin_user else f"<a href='tg://user?id={_admin_id}'>{html.escape(_admin_name)}</a>"
-                            _stamp = now_local_str("%Y-%m-%d %H:%M:%S")
-                            _cur = _m.get("text") or ""
-                            if ("<b>APPROVED</b>" not in _cur) and ("<b>REJECTED</b>" not in _cur):
-                                _cur = _cur + f"\n\n❌ <b>REJECTED</b>\nBy: {_who}\nAt: {_stamp}"
-                            edit_message(token, _chat_id, _msg_id, _cur, reply_markup={"inline_keyboard": []}, parse_mode="HTML")
+                        answer_callback(token, cq["id"], "Limit harian habis", show_alert=True)
                     except Exception:
-                        logger.exception("Failed to update admin withdrawal message (reject)")
-                    answer_callback(token, cq["id"], "Rejected ❌", show_alert=False)
+                        pass
+                try:
+                    send_message(token, chat_id, _msg or "Limit harian habis.", reply_markup=_kb_lim, parse_mode="HTML")
+                except Exception:
+                    # fallback without parse mode
+                    send_message(token, chat_id, _msg or "Limit harian habis.", reply_markup=_kb_lim)
+                return "OK", 200
+    except Exception:
+        pass
+    # ===== END DAILY SCAN LIMIT GATE =====
 
-                else:
-                    answer_callback(token, cq["id"], "Unknown action", show_alert=True)
+    act = actions_get(bot_id, key)
 
-            return "OK", 200
+    # answer quickly to stop Telegram spinner
+    answer_callback_fast(token, cq["id"])
+
+    if not act:
+        # Scanner fallback: if key matches a provider that has scanner media + games, run scanner.
+        try:
+            with engine.begin() as conn:
+                media = get_scanner_media(conn, bot_id, key)
+                games = get_scanner_games(conn, bot_id, key) if media else []
+                if media and games:
+                    # gate + cooldown
+                    urow_gate = user_row or get_user_row(bot_id, uid) or {"user_id": uid}
+                    if not ensure_access(bot_row, chat_id, uid, urow_gate):
+                        return "OK", 200
+                    # daily scan limit (per day)
+                    allowed, used_after, lim = scan_daily_touch_or_block(conn, bot_row, bot_id, int(uid))
+                    if not allowed:
+                        bot_latest = get_bot_by_id(bot_id) or bot_row
+                        urow_lim = urow_gate
+                        tpl = bot_latest.get("scan_limit_message") or (
+                            "❌ <b>LIMIT SCAN HARI INI HABIS</b>\\n"
+                            "Anda dah capai limit scan untuk hari ini. Cuba lagi esok."
+                        )
+                        txt_lim = render_placeholders(tpl, bot_latest.get("bot_username") or "", urow_lim)
+                        if lim is not None and lim > 0:
+                            txt_lim = (txt_lim + f"\\n\\n📌 Used: <b>{used_after}/{lim}</b>").strip()
+                        kb_lim = _KB_BACK_MENU_SCANNER
 
-        # your existing cb:
-        elif data.startswith("cb:"):
-            # Callback actions stored in DB (premium mode: edit in-place)
-            raw = data.split(":", 1)[1].strip()
-            delay_override = None
-            if ";d=" in raw:
-                key_part, d_part = raw.split(";d=", 1)
-                raw = key_part.strip()
-                mdel = re.match(r"^(\d+)", (d_part or "").strip())
-                if mdel:
+                        mt_lim = bot_latest.get("scan_limit_message_media_type")
+                        mf_lim = bot_latest.get("scan_limit_message_media_file_id")
+                        try:
+                            if mt_lim and mf_lim:
+                                # try edit as media (if current message is media); else send as new media
+                                try:
+                                    edit_media(token, chat_id, message_id, mt_lim, mf_lim, caption=txt_lim, reply_markup=kb_lim, parse_mode="HTML")
+                                except Exception:
+                                    send_media(token, chat_id, mt_lim, mf_lim, caption=txt_lim, reply_markup=kb_lim, parse_mode="HTML")
+                            else:
+                                edit_message(token, chat_id, message_id, txt_lim or " ", reply_markup=kb_lim, parse_mode="HTML")
+                        except Exception:
+                            send_message(token, chat_id, txt_lim or " ", reply_markup=kb_lim, parse_mode="HTML")
+                        return "OK", 200
+
+                    remaining = scanner_check_and_touch_cooldown(conn, bot_id, int(uid), key, cooldown_seconds=5)
+                    scanner_cooldown_mark(bot_id, int(uid), key, remaining if remaining > 0 else 5)
+                    if remaining > 0:
+                        return "OK", 200
+                    firstname = (from_user.get("first_name") or "").strip()
+                    # BM rotation + progress bar (edit in-place)
                     try:
-                        delay_override = int(mdel.group(1))
+                        animate_scanning_progress(token, chat_id, message_id, provider=key, cycles=1, delay=0.55)
                     except Exception:
-                        delay_override = None
-            key = raw.strip()
-            # normalize scan_* keys -> provider (e.g., scan_jili -> jili)
-            if key.startswith("scan_"):
-                key = key.split("scan_", 1)[1]
+                        pass
+                    if not send_scanner_result_edit(token, chat_id, message_id, firstname, key, media, games):
+                        send_scanner_result(token, chat_id, firstname, key, _coerce_media_dict(media), games)
+                    return "OK", 200
+        except Exception as e:
+            logger.exception("scanner fallback error: %s", e)
+        return "OK", 200
+
+    # Ensure user passes gate for any callback
+    if not ensure_access(bot_row, chat_id, uid, user_row):
+        return "OK", 200
 
-            # ===== DAILY SCAN LIMIT GATE (for scanner providers, even if action exists) =====
+    delay = int(delay_override if delay_override is not None else (act.get("delay_seconds") or 0))
+
+    # If no message_id to edit, fallback to sending new message
+    if not message_id:
+        txt, markup = _render_action(bot_row, act, bot_id, uid)
+        _emit_action(token, chat_id, None, act, txt, markup)
+        return "OK", 200
+
+    # No delay -> jump directly to callback result (fast chaining)
+    if delay <= 0:
+        txt, markup = _render_action(bot_row, act, bot_id, uid)
+        _emit_action(token, chat_id, message_id, act, txt, markup)
+        return "OK", 200
+
+    # Delay > 0 -> cinematic LOADING then edit back to result using Cloud Tasks
+    urow = get_user_row(bot_id, uid) or {
+        "user_id": uid,
+        "first_name": from_user.get("first_name") or "",
+        "username": from_user.get("username"),
+        "balance": 0,
+        "shared_count": 0,
+        "member_id": "000000",
+    }
+    # Step 1: edit current message into LOADING
+    edit_loading_message(bot_row, chat_id, message_id, urow)
+
+    # Step 2: queue delayed action
+    if can_use_tasks_action():
+        enqueue_action_task(pack_action_task(bot_id, chat_id, uid, message_id, key), delay_seconds=delay)
+    else:
+        # Fallback (less reliable on Cloud Run): shared in-process scheduler
+        def _later(act2=act):
+            u2 = get_user_row(bot_id, uid) or {"user_id": uid}
+            if not ensure_access(bot_row, chat_id, uid, u2):
+                return
+            t2 = render_placeholders(act2.get("text") or "", bot_row.get("bot_username") or "", u2)
+            q2 = make_share_query(bot_row.get("bot_username") or "", u2)
+            t2, mk2 = parse_buttons(t2, share_inline_query=q2)
             try:
-                with engine.begin() as _conn_gate:
-                    _media_gate = None
-                    _games_gate = None
-                    try:
-                        _media_gate = get_scanner_media(_conn_gate, bot_id, key)
-                    except Exception:
-                        _media_gate = None
-                    try:
-                        _games_gate = get_scanner_games(_conn_gate, bot_id, key) or []
-                    except Exception:
-                        _games_gate = []
-                    _is_scanner = bool(_media_gate) or bool(_games_gate)
-
-                    if _is_scanner:
-                        # fetch latest bot config (in case just updated)
-                        _bot_latest = get_bot_by_id(bot_id) or bot_row
-                        _allowed, _used_after, _lim = scan_daily_touch_or_block(_conn_gate, _bot_latest, bot_id, int(uid))
-                        if not _allowed:
-                            _urow_gate = user_row or get_user_row(bot_id, uid) or {"user_id": uid, "username": username, "first_name": firstname}
-                            _tpl = (_bot_latest.get("scan_limit_message") or "").strip() or "🚫 Had scan harian anda telah habis.\nLimit: {limit}/hari\nCuba semula esok."
-                            _msg = render_placeholders(_tpl, _bot_latest.get("bot_username") or "", _urow_gate)
-                            _msg = apply_scan_placeholders(_conn_gate, _msg, _bot_latest, bot_id, int(uid))
-                            # extra placeholders
-                            if _lim is None:
-                                _lim_int = 0
-                            else:
-                                try:
-                                    _lim_int = int(_lim)
-                                except Exception:
-                                    _lim_int = 0
-                            try:
-                                _used_int = int(_used_after)
-                            except Exception:
-                                _used_int = 0
-                            _remaining = max(0, _lim_int - _used_int) if _lim_int > 0 else 0
-
-                            _msg = (_msg
-                                    .replace("{limit}", str(_lim_int if _lim_int else _lim or ""))
-                                    .replace("{used}", str(_used_int))
-                                    .replace("{remaining}", str(_remaining)))
-
-                            _kb_lim = {"inline_keyboard": [[{"text": "⬅️ Kembali", "callback_data": "cb:menuscanner"}]]}
-
-                            # always show alert + send new message (do NOT edit old media message)
-                            try:
-                                answer_callback(token, cq["id"], (_msg[:180] if _msg else "Limit harian habis"), show_alert=True)
-                            except Exception:
-                                try:
-                                    answer_callback(token, cq["id"], "Limit harian habis", show_alert=True)
-                                except Exception:
-                                    pass
-                            try:
-                                send_message(token, chat_id, _msg or "Limit harian habis.", reply_markup=_kb_lim, parse_mode="HTML")
-                            except Exception:
-                                # fallback without parse mode
-                                send_message(token, chat_id, _msg or "Limit harian habis.", reply_markup=_kb_lim)
-                            return "OK", 200
+                if act2["type"] != "text" and act2.get("media_file_id"):
+                    edit_media(token, chat_id, message_id, act2["type"], act2["media_file_id"], caption=t2, reply_markup=mk2, parse_mode="HTML")
+                else:
+                    edit_message(token, chat_id, message_id, t2 or " ", reply_markup=mk2, parse_mode="HTML")
             except Exception:
-                pass
-            # ===== END DAILY SCAN LIMIT GATE =====
+                send_message(token, chat_id, t2 or " ", reply_markup=mk2, parse_mode="HTML")
 
-            act = actions_get(bot_id, key)
+        if not schedule_later(delay, _later):
+            logger.warning(f"[DELAY] queue full, drop cb bot={bot_id} key={key}")
+            send_message(token, chat_id, "⏳ Server sibuk sekarang. Sila tekan semula sebentar lagi.", parse_mode="HTML")
 
-            # answer quickly to stop Telegram spinner
-            answer_callback(token, cq["id"])
+    return "OK", 200
 
-            if not act:
-                # Scanner fallback: if key matches a provider that has scanner media + games, run scanner.
-                try:
-                    with engine.begin() as conn:
-                        media = get_scanner_media(conn, bot_id, key)
-                        games = get_scanner_games(conn, bot_id, key) if media else []
-                        if media and games:
-                            # gate + cooldown
-                            urow_gate = user_row or get_user_row(bot_id, uid) or {"user_id": uid}
-                            if not ensure_access(bot_row, chat_id, uid, urow_gate):
-                                return "OK", 200
-                            # daily scan limit (per day)
-                            allowed, used_after, lim = scan_daily_touch_or_block(conn, bot_row, bot_id, int(uid))
-                            if not allowed:
-                                bot_latest = get_bot_by_id(bot_id) or bot_row
-                                urow_lim = urow_gate
-                                tpl = bot_latest.get("scan_limit_message") or (
-                                    "❌ <b>LIMIT SCAN HARI INI HABIS</b>\\n"
-                                    "Anda dah capai limit scan untuk hari ini. Cuba lagi esok."
-                                )
-                                txt_lim = render_placeholders(tpl, bot_latest.get("bot_username") or "", urow_lim)
-                                if lim is not None and lim > 0:
-                                    txt_lim = (txt_lim + f"\\n\\n📌 Used: <b>{used_after}/{lim}</b>").strip()
-                                kb_lim = {"inline_keyboard": [[{"text": "⬅️ Kembali", "callback_data": "cb:menuscanner"}]]}
-
-                                mt_lim = bot_latest.get("scan_limit_message_media_type")
-                                mf_lim = bot_latest.get("scan_limit_message_media_file_id")
-                                try:
-                                    if mt_lim and mf_lim:
-                                        # try edit as media (if current message is media); else send as new media
-                                        try:
-                                            edit_media(token, chat_id, message_id, mt_lim, mf_lim, caption=txt_lim, reply_markup=kb_lim, parse_mode="HTML")
-                                        except Exception:
-                                            send_media(token, chat_id, mt_lim, mf_lim, caption=txt_lim, reply_markup=kb_lim, parse_mode="HTML")
-                                    else:
-                                        edit_message(token, chat_id, message_id, txt_lim or " ", reply_markup=kb_lim, parse_mode="HTML")
-                                except Exception:
-                                    send_message(token, chat_id, txt_lim or " ", reply_markup=kb_lim, parse_mode="HTML")
-                                return "OK", 200
-
-                            remaining = scanner_check_and_touch_cooldown(conn, bot_id, int(uid), key, cooldown_seconds=5)
-                            if remaining > 0:
-                                # small toast
-                                answer_callback(token, cq["id"], text=f"⏳ Tunggu {remaining}s", show_alert=False)
-                                return "OK", 200
-                            firstname = (from_user.get("first_name") or "").strip()
-                            # BM rotation + progress bar (edit in-place)
-                            try:
-                                animate_scanning_progress(token, chat_id, message_id, provider=key, cycles=1, delay=0.55)
-                            except Exception:
-                                pass
-                            if not send_scanner_result_edit(token, chat_id, message_id, firstname, key, media, games):
-                                send_scanner_result(token, chat_id, firstname, key, _coerce_media_dict(media), games)
-                            return "OK", 200
-                except Exception as e:
-                    logger.exception("scanner fallback error: %s", e)
-                return "OK", 200
 
-            # Ensure user passes gate for any callback
-            if not ensure_access(bot_row, chat_id, uid, user_row):
-                return "OK", 200
+def _cb_req_withdraw(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # Withdraw button
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
 
-            delay = int(delay_override if delay_override is not None else (act.get("delay_seconds") or 0))
-
-            # If no message_id to edit, fallback to sending new message
-            if not message_id:
-                urow = get_user_row(bot_id, uid) or {"user_id": uid}
-                txt = render_placeholders(act.get("text") or "", bot_row.get("bot_username") or "", urow)
-                # scan placeholders ({count}/{limit}/{remaining}/{reset})
-                with engine.connect() as _c:
-                    txt = apply_scan_placeholders(_c, txt, bot_row, bot_id, int((urow or {}).get("user_id") or uid))
-                share_q = make_share_query(bot_row.get("bot_username") or "", urow)
-                txt, markup = parse_buttons(txt, share_inline_query=share_q)
-                send_message(token, chat_id, txt or " ", reply_markup=markup, parse_mode="HTML")
-                return "OK", 200
+    # Block withdrawal request if balance not enough (show popup alert)
+    min_wd = get_bot_min_withdraw(bot_row)
+    # user_row baru dibaca oleh upsert_user() dalam request ni - guna terus balance dia
+    if user_row and "balance" in user_row:
+        bal0 = float(user_row.get("balance") or 0)
+    else:
+        with engine.connect() as conn:
+            bal0 = float(conn.execute(SQL_SEL_BALANCE, {"b": bot_id, "u": int(from_user.get("id") or 0)}).scalar() or 0)
 
-            # No delay -> jump directly to callback result (fast chaining)
-            if delay <= 0:
-                urow = get_user_row(bot_id, uid) or {"user_id": uid}
-                txt = render_placeholders(act.get("text") or "", bot_row.get("bot_username") or "", urow)
-                # scan placeholders ({count}/{limit}/{remaining}/{reset})
-                with engine.connect() as _c:
-                    txt = apply_scan_placeholders(_c, txt, bot_row, bot_id, int((urow or {}).get("user_id") or uid))
-                share_q = make_share_query(bot_row.get("bot_username") or "", urow)
-                txt, markup = parse_buttons(txt, share_inline_query=share_q)
-
-                if act["type"] != "text" and act.get("media_file_id"):
-                    # Prefer media edit when action includes media
-                    try:
-                        edit_media(token, chat_id, message_id, act["type"], act["media_file_id"], caption=txt, reply_markup=markup, parse_mode="HTML")
-                    except Exception:
-                        # fallback edit text
-                        edit_message(token, chat_id, message_id, txt or " ", reply_markup=markup, parse_mode="HTML")
-                else:
-                    edit_message(token, chat_id, message_id, txt or " ", reply_markup=markup, parse_mode="HTML")
-                return "OK", 200
+    if bal0 < float(min_wd):
+        answer_callback(token, cq["id"], build_withdraw_insufficient_msg(float(min_wd), float(bal0)), show_alert=True)
+        return "OK", 200
 
-            # Delay > 0 -> cinematic LOADING then edit back to result using Cloud Tasks
-            urow = get_user_row(bot_id, uid) or {
-                "user_id": uid,
-                "first_name": from_user.get("first_name") or "",
-                "username": from_user.get("username"),
-                "balance": 0,
-                "shared_count": 0,
-                "member_id": "000000",
-            }
-            # Step 1: edit current message into LOADING
-            edit_loading_message(bot_row, chat_id, message_id, urow)
-
-            # Step 2: queue delayed action
-            if can_use_tasks_action():
-                enqueue_action_task(
-                    {"bot_id": bot_id, "chat_id": chat_id, "user_id": uid, "message_id": message_id, "key": key},
-                    delay_seconds=delay,
-                )
-            else:
-                # Fallback (less reliable on Cloud Run): background timer
-                import threading
-
-                def _later():
-                    act2 = actions_get(bot_id, key)
-                    if not act2:
-                        return
-                    u2 = get_user_row(bot_id, uid) or {"user_id": uid}
-                    if not ensure_access(bot_row, chat_id, uid, u2):
-                        return
-                    t2 = render_placeholders(act2.get("text") or "", bot_row.get("bot_username") or "", u2)
-                    q2 = make_share_query(bot_row.get("bot_username") or "", u2)
-                    t2, mk2 = parse_buttons(t2, share_inline_query=q2)
-                    try:
-                        if act2["type"] != "text" and act2.get("media_file_id"):
-                            edit_media(token, chat_id, message_id, act2["type"], act2["media_file_id"], caption=t2, reply_markup=mk2, parse_mode="HTML")
-                        else:
-                            edit_message(token, chat_id, message_id, t2 or " ", reply_markup=mk2, parse_mode="HTML")
-                    except Exception:
-                        send_message(token, chat_id, t2 or " ", reply_markup=mk2, parse_mode="HTML")
+    handle_withdraw_request(bot_row, chat_id, from_user)
+    answer_callback_fast(token, cq["id"])
+    return "OK", 200
 
-                threading.Timer(delay, _later).start()
 
-            return "OK", 200
-        elif data == "req_withdraw":
-            # Block withdrawal request if balance not enough (show popup alert)
-            bot_id_ = str(bot_row["id"])
-            uid_int = int(from_user.get("id") or 0)
-            min_wd = get_bot_min_withdraw(bot_row)
-            with engine.connect() as conn:
-                urow0 = conn.execute(
-                    text("SELECT balance FROM users WHERE bot_id=:b AND user_id=:u"),
-                    {"b": bot_id_, "u": uid_int},
-                ).mappings().first()
-            bal0 = float((urow0 or {}).get("balance") or 0)
+def _cb_settings(bot_row: dict, cq: dict, data: str, chat_id, message_id, from_user: dict, uid, user_row, cq_message_text: str):
+    # SETTINGS UI
+    token = bot_row["token"]
+    bot_id = str(bot_row["id"])
 
-            if bal0 < float(min_wd):
-                answer_callback(token, cq["id"], build_withdraw_insufficient_msg(float(min_wd), float(bal0)), show_alert=True)
-                return "OK", 200
+    if data == "st:noop":
+        answer_callback_fast(token, cq["id"])
+        return "OK", 200
 
-            handle_withdraw_request(bot_row, chat_id, from_user)
-            answer_callback(token, cq["id"])
-            return "OK", 200
+    if not require_admin(bot_row, uid):
+        answer_callback(token, cq["id"], "No access", show_alert=True)
+        return "OK", 200
 
-        # SETTINGS UI
-        elif data.startswith("st:"):
-            if data == "st:noop":
-                answer_callback(token, cq["id"])
-                return "OK", 200
+    # "st:<action>:<arg>"
+    action, _, arg = data.partition(":")[2].partition(":")
+
+    handler = _ST_HANDLERS.get(action)
+    page = handler(bot_row, cq["id"], action, arg, chat_id, message_id, uid) if handler else None
+    if handler is None:
+        answer_callback_fast(token, cq["id"])
+    elif page:
+        # common tail: redraw settings panel in-place. Bot row dibaca semula hanya bila
+        # action tukar row bots (toggle/admingroup); cbdel/cbpage/refresh guna bot_row sedia ada.
+        bot_row2 = (get_bot_by_id(bot_id) or bot_row) if action in _ST_MUTATES_BOT else bot_row
+        send_or_edit_settings_panel(bot_row2, chat_id, uid, page=page, edit_message_id=message_id)
+    return "OK", 200
 
-            if not require_admin(bot_row, uid):
-                answer_callback(token, cq["id"], "No access", show_alert=True)
-                return "OK", 200
 
-            parts = data.split(":")
-            action = parts[1] if len(parts) > 1 else ""
-
-            if action in ("lock", "join", "manual", "inplace"):
-                val = (parts[2] == "on") if len(parts) > 2 else False
-                col = {
-                    "lock": "lock_bot",
-                    "join": "join_lock",
-                    "manual": "manual_approval",
-                    "inplace": "inplace_callbacks",
-                }[action]
-                with engine.begin() as conn:
-                    conn.execute(text(f"UPDATE bots SET {col}=:v WHERE id=:i"), {"v": val, "i": bot_id})
-                answer_callback(token, cq["id"], f"{col} set: {val}")
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_ctx={"message_id": message_id})
-                return "OK", 200
+# st:<action>:... handlers. Return page number -> panel di-redraw oleh _cb_settings; None -> siap.
+# Column toggle: nama column dari map tetap (bukan dari callback data).
+_ST_COL_MAP = {
+    "lock": "lock_bot",
+    "join": "join_lock",
+    "manual": "manual_approval",
+    "inplace": "inplace_callbacks",
+}
+SQL_UPD_BOT_FLAG = {col: text(f"UPDATE bots SET {col}=:v WHERE id=:i") for col in _ST_COL_MAP.values()}
+# actions yang UPDATE bots -> panel perlu bot row baru
+_ST_MUTATES_BOT = frozenset(_ST_COL_MAP) | {"admingroup"}
 
-            if action == "admingroup":
-                if int(chat_id) >= 0:
-                    answer_callback(token, cq["id"], "Tekan button ni dalam GROUP (bukan PM).", show_alert=True)
-                    return "OK", 200
-                with engine.begin() as conn:
-                    conn.execute(text("UPDATE bots SET admin_group_id=:g WHERE id=:i"), {"g": chat_id, "i": bot_id})
-                answer_callback(token, cq["id"], "Admin group saved ✅")
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_ctx={"message_id": message_id})
-                return "OK", 200
+_ST_HANDLERS: Dict[str, object] = {}
 
-            if action == "preview":
-                which = parts[2] if len(parts) > 2 else ""
-                if which == "start":
-                    preview_start(bot_row, chat_id, uid)
-                elif which == "loading":
-                    preview_loading(bot_row, chat_id, uid)
-                answer_callback(token, cq["id"])
-                return "OK", 200
 
-            if action == "how":
-                topic = parts[2] if len(parts) > 2 else ""
-                send_message(token, chat_id, settings_how(topic), parse_mode="HTML")
-                answer_callback(token, cq["id"])
-                return "OK", 200
+def st_handler(*names: str):
+    """Register a st:<name> handler in _ST_HANDLERS."""
+    def deco(fn):
+        for n in names:
+            _ST_HANDLERS[n] = fn
+        return fn
+    return deco
 
-            if action == "placeholders":
-                send_message(token, chat_id, HELP_PLACEHOLDERS_FULL, parse_mode="HTML")
-                answer_callback(token, cq["id"])
-                return "OK", 200
 
-            if action == "cbpage":
-                try:
-                    page = int(parts[2])
-                except Exception:
-                    page = 1
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=page, edit_ctx={"message_id": message_id})
-                answer_callback(token, cq["id"])
-                return "OK", 200
+def _st_page_arg(arg: str, default: int) -> int:
+    return int(arg) if arg.isdigit() else default
 
-            if action == "refresh":
-                try:
-                    page = int(parts[2])
-                except Exception:
-                    page = 1
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=page, edit_ctx={"message_id": message_id})
-                answer_callback(token, cq["id"])
-                return "OK", 200
 
-            if action == "export":
-                which = parts[2] if len(parts) > 2 else "all"
-                export_users_excel(bot_row, chat_id, target=("verified" if which == "verified" else "all"))
-                answer_callback(token, cq["id"], "Export sent ✅")
-                return "OK", 200
+@st_handler(*_ST_COL_MAP)
+def _st_toggle(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    bot_id = str(bot_row["id"])
+    val = arg == "on"
+    col = _ST_COL_MAP[action]
+    with engine.begin() as conn:
+        conn.execute(SQL_UPD_BOT_FLAG[col], {"v": val, "i": bot_id})
+    invalidate_bot_cache(bot_id)
+    answer_callback(bot_row["token"], cq_id, f"{col} set: {val}")
+    return 1
 
-            if action == "mybots":
-                try:
-                    page = int(parts[2])
-                except Exception:
-                    page = 0
-                send_mybots(bot_row, chat_id, int(bot_row["owner_id"]), page=page)
-                answer_callback(token, cq["id"])
-                return "OK", 200
 
-            if action == "cbdelmenu":
-                cb_total, cb_rows = get_callbacks_page(bot_id, 1, SETTINGS_CB_PAGE_SIZE)
-                if not cb_rows:
-                    answer_callback(token, cq["id"], "No callbacks", show_alert=True)
-                    return "OK", 200
-                kb = {"inline_keyboard": []}
-                for r in cb_rows[:10]:
-                    kb["inline_keyboard"].append([
-                        {"text": f"🗑 {r['key']}", "callback_data": f"st:cbdel:{r['key']}"}
-                    ])
-                kb["inline_keyboard"].append([
-                    {"text": "⬅️ Back Panel", "callback_data": "st:refresh:1"}
-                ])
-                send_message(token, chat_id, "🗑 <b>Delete Callback</b>\nPilih key untuk delete:", reply_markup=kb, parse_mode="HTML")
-                answer_callback(token, cq["id"])
-                return "OK", 200
+@st_handler("admingroup")
+def _st_admingroup(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    if int(chat_id) >= 0:
+        answer_callback(bot_row["token"], cq_id, "Tekan button ni dalam GROUP (bukan PM).", show_alert=True)
+        return None
+    bot_id = str(bot_row["id"])
+    with engine.begin() as conn:
+        conn.execute(SQL_UPD_ADMIN_GROUP, {"g": chat_id, "i": bot_id})
+    invalidate_bot_cache(bot_id)
+    answer_callback(bot_row["token"], cq_id, "Admin group saved ✅")
+    return 1
 
-            if action == "cbdel":
-                key = parts[2] if len(parts) > 2 else ""
-                if not key:
-                    answer_callback(token, cq["id"], "Missing key", show_alert=True)
-                    return "OK", 200
-                ok = delete_callback(bot_id, key)
-                answer_callback(token, cq["id"], "Deleted ✅" if ok else "Not found ⚠️", show_alert=False)
-                bot_row2 = get_bot_by_id(bot_id) or bot_row
-                send_or_edit_settings_panel(bot_row2, chat_id, uid, page=1, edit_ctx={"message_id": message_id})
-                return "OK", 200
 
-            answer_callback(token, cq["id"])
-            return "OK", 200
+@st_handler("preview")
+def _st_preview(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    if arg == "start":
+        preview_start(bot_row, chat_id, uid)
+    elif arg == "loading":
+        preview_loading(bot_row, chat_id, uid)
+    answer_callback_fast(bot_row["token"], cq_id)
+    return None
 
-        answer_callback(token, cq["id"])
-        return "OK", 200
 
-    return "OK", 200
+@st_handler("how")
+def _st_how(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    send_message(bot_row["token"], chat_id, settings_how(arg), parse_mode="HTML")
+    answer_callback_fast(bot_row["token"], cq_id)
+    return None
+
+
+@st_handler("placeholders")
+def _st_placeholders(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    send_message(bot_row["token"], chat_id, HELP_PLACEHOLDERS_FULL, parse_mode="HTML")
+    answer_callback_fast(bot_row["token"], cq_id)
+    return None
+
+
+@st_handler("cbpage", "refresh")
+def _st_page(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    # cbpage / refresh
+    answer_callback_fast(bot_row["token"], cq_id)
+    return _st_page_arg(arg, 1)
+
+
+@st_handler("export")
+def _st_export(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    which = arg or "all"
+    export_users_excel(bot_row, chat_id, target=("verified" if which == "verified" else "all"))
+    answer_callback(bot_row["token"], cq_id, "Export sent ✅")
+    return None
+
+
+@st_handler("mybots")
+def _st_mybots(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    send_mybots(bot_row, chat_id, int(bot_row["owner_id"]), page=_st_page_arg(arg, 0))
+    answer_callback_fast(bot_row["token"], cq_id)
+    return None
+
+
+# Telegram call kecil yang boleh jalan selari dengan kerja request (bukan delayed job)
+_TG_IO_EXEC = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tg-io")
+
+_ROW_BACK_PANEL = [{"text": "⬅️ Back Panel", "callback_data": "st:refresh:1"}]
+
+
+def _cbdel_menu_kb(cb_rows) -> dict:
+    rows = [[{"text": "🗑 " + k, "callback_data": "st:cbdel:" + k}] for k in (r["key"] for r in cb_rows[:10])]
+    rows.append(_ROW_BACK_PANEL)
+    return {"inline_keyboard": rows}
+
+
+@st_handler("cbdelmenu")
+def _st_cbdelmenu(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    token = bot_row["token"]
+    cb_total, cb_rows = get_callbacks_page(str(bot_row["id"]), 1, SETTINGS_CB_PAGE_SIZE)
+    if not cb_rows:
+        answer_callback(token, cq_id, "No callbacks", show_alert=True)
+        return None
+    kb = _cbdel_menu_kb(cb_rows)
+    send_message(token, chat_id, "🗑 <b>Delete Callback</b>\nPilih key untuk delete:", reply_markup=kb, parse_mode="HTML")
+    answer_callback(token, cq_id)
+    return None
+
+
+@st_handler("cbdel")
+def _st_cbdel(bot_row: dict, cq_id: str, action: str, arg: str, chat_id, message_id, uid) -> Optional[int]:
+    key = arg
+    if not key:
+        answer_callback(bot_row["token"], cq_id, "Missing key", show_alert=True)
+        return None
+    bot_id = str(bot_row["id"])
+    ok = delete_callback(bot_id, key)
+    # toast jalan serentak dengan edit menu / panel redraw, bukan satu lepas satu
+    _TG_IO_EXEC.submit(answer_callback, bot_row["token"], cq_id, "Deleted ✅" if ok else "Not found ⚠️", False)
+    # Masih ada key -> patch keyboard menu delete sahaja (text tak berubah);
+    # list dah kosong -> redraw panel penuh (_cb_settings tail)
+    cb_total, cb_rows = get_callbacks_page(bot_id, 1, SETTINGS_CB_PAGE_SIZE)
+    if cb_rows and message_id:
+        edit_reply_markup(bot_row["token"], chat_id, message_id, _cbdel_menu_kb(cb_rows))
+        return None
+    return 1
+
+
+_CB_DISPATCH = {
+    "gate": _cb_gate,
+    "adm": _cb_adm,
+    "wd": _cb_wd,
+    "cb": _cb_action,
+    "req_withdraw": _cb_req_withdraw,
+    "st": _cb_settings,
+}
 
 
 @app.post("/webhook")
@@ -4275,9 +5102,14 @@ def webhook_alias():
 
 def get_admin_target_chat_id(bot_row: dict) -> int:
     """Return chat_id for admin notifications (group if set, else owner)."""
+    v = bot_row.get("admin_group_id") or bot_row.get("owner_id")
+    if v is None:
+        return 0
+    if isinstance(v, int):
+        return v
     try:
-        return int(bot_row.get("admin_group_id") or bot_row.get("owner_id") or 0)
-    except Exception:
+        return int(v)
+    except (TypeError, ValueError):
         return 0
 
 
@@ -4290,32 +5122,97 @@ def build_premium_approval_keyboard(uid: int):
     }
 
 
+# Keyboard yang sama, di-serialize sekali; hanya uid berubah (guna dengan reply_markup_json=)
+_PREMIUM_KB_JSON_TPL = json.dumps(build_premium_approval_keyboard(0)).replace("adm:ap:0", "adm:ap:%d").replace("adm:rj:0", "adm:rj:%d")
+
+
+def premium_approval_keyboard_json(uid: int) -> str:
+    return _PREMIUM_KB_JSON_TPL % (int(uid), int(uid))
+
+
+# Template dibina sekali; nilai user di-escape sebelum masuk
+_PREMIUM_REQ_HEADER = "🔔 <b>PREMIUM REQUEST (MANUAL)</b>\n"
+_PREMIUM_REQ_ITEM_TPL = (
+    "👤 Nama: <b>{fn}</b>\n"
+    "🔖 Username: <code>{un}</code>\n"
+    "🆔 UID: <code>{uid}</code>\n"
+    "📞 Phone: <code>{phone}</code>\n"
+    "🎫 Member ID: <code>{member_id}</code>\n"
+    "💰 Balance: <b>RM{bal:.2f}</b>\n\n"
+).format_map
+_PREMIUM_REQ_FOOTER = (
+    "Tekan button di bawah untuk approve/reject.\n"
+    "Atau reply mesej ini dengan <code>/approve</code> atau <code>/reject</code>."
+)
+_PREMIUM_REQ_FOOTER_MULTI = "Tekan button ikut UID di bawah untuk approve/reject."
+
+# Request premium ke admin chat yang sama dalam window pendek -> satu mesej
+# (Telegram had ~1 msg/s per chat). Satu request sahaja -> mesej asal, tiada beza.
+PREMIUM_COALESCE_SECONDS = 0.25
+PREMIUM_COALESCE_MAX = 10
+_PENDING_ADMIN: Dict[Tuple[str, int], List[Tuple[int, str]]] = {}
+_PENDING_ADMIN_LOCK = threading.Lock()
+
+
+def _send_admin_msg(token: str, admin_chat: int, msg: str, kb_json: str) -> None:
+    if not send_message_async(token, admin_chat, msg, parse_mode="HTML", reply_markup_json=kb_json):
+        logger.warning(f"outbound queue full, sending premium request inline chat={admin_chat}")
+        send_message(token, admin_chat, msg, parse_mode="HTML", reply_markup_json=kb_json)
+
+
+def _premium_multi_kb_json(uids: List[int]) -> str:
+    return json.dumps({"inline_keyboard": [[
+        {"text": f"✅ {u}", "callback_data": f"adm:ap:{u}"},
+        {"text": f"❌ {u}", "callback_data": f"adm:rj:{u}"},
+    ] for u in uids]})
+
+
+def _flush_admin(token: str, admin_chat: int) -> None:
+    with _PENDING_ADMIN_LOCK:
+        items = _PENDING_ADMIN.pop((token, admin_chat), None) or []
+    if len(items) == 1:
+        uid, body = items[0]
+        _send_admin_msg(token, admin_chat, _PREMIUM_REQ_HEADER + body + _PREMIUM_REQ_FOOTER, premium_approval_keyboard_json(uid))
+        return
+    # pecah ikut had item + panjang text
+    batch: List[Tuple[int, str]] = []
+    size = 0
+    for it in items + [None]:
+        if batch and (it is None or len(batch) >= PREMIUM_COALESCE_MAX or size + len(it[1]) > TG_MAX_TEXT - 200):
+            head = _PREMIUM_REQ_HEADER.replace("</b>", f" x{len(batch)}</b>", 1) + "\n"
+            msg = head + "".join(b for _, b in batch) + _PREMIUM_REQ_FOOTER_MULTI
+            _send_admin_msg(token, admin_chat, msg, _premium_multi_kb_json([u for u, _ in batch]))
+            batch, size = [], 0
+        if it is not None:
+            batch.append(it)
+            size += len(it[1])
+
+
 def send_premium_request_to_admin(bot_row: dict, uid: int, user_row: dict):
-    """Send manual premium approval request to admin target."""
-    token = bot_row["token"]
+    """Send manual premium approval request to admin target (coalesced per admin chat)."""
     admin_chat = get_admin_target_chat_id(bot_row)
     if not admin_chat:
         return
 
-    fn = (user_row or {}).get("first_name") or ""
-    un = (user_row or {}).get("username") or ""
-    phone = (user_row or {}).get("phone") or ""
-    member_id = (user_row or {}).get("member_id") or ""
-    bal = float((user_row or {}).get("balance") or 0)
-
-    header = "🔔 <b>PREMIUM REQUEST (MANUAL)</b>\n"
-    body = (
-        f"👤 Nama: <b>{html.escape(fn) or '-'}</b>\n"
-        f"🔖 Username: <code>{html.escape(un) if un else '-'}</code>\n"
-        f"🆔 UID: <code>{uid}</code>\n"
-        f"📞 Phone: <code>{html.escape(phone) if phone else '-'}</code>\n"
-        f"🎫 Member ID: <code>{html.escape(member_id) if member_id else '-'}</code>\n"
-        f"💰 Balance: <b>RM{bal:.2f}</b>\n\n"
-        "Tekan button di bawah untuk approve/reject.\n"
-        "Atau reply mesej ini dengan <code>/approve</code> atau <code>/reject</code>."
-    )
-    kb = build_premium_approval_keyboard(uid)
-    send_message(token, admin_chat, header + body, reply_markup=kb, parse_mode="HTML")
+    token = bot_row["token"]
+    user_row = user_row or {}
+    body = _PREMIUM_REQ_ITEM_TPL({
+        "fn": _esc(user_row.get("first_name")),
+        "un": _esc(user_row.get("username")),
+        "uid": uid,
+        "phone": _esc(user_row.get("phone")),
+        "member_id": _esc(user_row.get("member_id")),
+        "bal": float(user_row.get("balance") or 0),
+    })
+    ck = (token, admin_chat)
+    with _PENDING_ADMIN_LOCK:
+        pending = _PENDING_ADMIN.get(ck)
+        if pending is not None:
+            pending.append((int(uid), body))
+            return
+        _PENDING_ADMIN[ck] = [(int(uid), body)]
+    if not schedule_later(PREMIUM_COALESCE_SECONDS, lambda: _flush_admin(token, admin_chat)):
+        _flush_admin(token, admin_chat)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
\ No newline at end of file
+    app.run(host="0.0.0.0", port=PORT)
\ No newline at end of file